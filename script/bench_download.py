@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+"""
+This internal script benchmarks download_from_url throughput against a local
+HTTP server, comparing small (1 KiB) chunks against the default chunk size.
+
+Usage: bench_download.py [SIZE_IN_MIB]
+
+"""
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from functools import partial
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+
+from ideuy.download import download_from_url
+
+DEFAULT_SIZE_MIB = 256
+CHUNK_SIZES = [1024, None]
+
+
+class QuietHandler(SimpleHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+
+def serve(directory):
+    handler = partial(QuietHandler, directory=directory)
+    server = ThreadingHTTPServer(('127.0.0.1', 0), handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server
+
+
+def main():
+    size_mib = int(sys.argv[1]) if len(sys.argv) > 1 else DEFAULT_SIZE_MIB
+
+    src_dir = tempfile.mkdtemp()
+    dst_dir = tempfile.mkdtemp()
+    try:
+        with open(os.path.join(src_dir, 'tile.tif'), 'wb') as f:
+            for _ in range(size_mib):
+                f.write(os.urandom(1024 * 1024))
+
+        server = serve(src_dir)
+        host, port = server.server_address
+        url = f'http://{host}:{port}/tile.tif'
+
+        for chunk_size in CHUNK_SIZES:
+            # Download into a new output dir each time, as files already in
+            # the manifest of an output dir are skipped
+            output_dir = tempfile.mkdtemp(dir=dst_dir)
+            start = time.perf_counter()
+            dst, _ = download_from_url(url,
+                                       output_dir,
+                                       use_cache=False,
+                                       chunk_size=chunk_size)
+            elapsed = time.perf_counter() - start
+            assert os.path.getsize(dst) == size_mib * 1024 * 1024
+            print(f"chunk size {chunk_size or 'default'}: "
+                  f"{elapsed:.2f} s, {size_mib / elapsed:.1f} MiB/s")
+
+        server.shutdown()
+    finally:
+        shutil.rmtree(src_dir)
+        shutil.rmtree(dst_dir)
+
+
+if __name__ == '__main__':
+    main()
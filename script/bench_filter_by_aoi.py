@@ -0,0 +1,69 @@
+#!/usr/bin/env python3
+"""
+This internal script benchmarks the grid intersection step of filter_by_aoi,
+comparing a linear scan over all grid cells against the grid spatial index.
+
+Random rectangular AOIs are generated inside the bounds of each bundled grid
+(grids not present in the data directory are skipped).
+
+"""
+import os
+import random
+import timeit
+
+import fiona
+from shapely.geometry import box, shape
+
+from ideuy.grid import load_grid_index
+from ideuy.vector import GRIDS_BY_TYPE
+
+NUM_AOIS = 100
+REPEAT = 3
+
+
+def random_aois(bounds, n, seed=0):
+    rnd = random.Random(seed)
+    minx, miny, maxx, maxy = bounds
+    w, h = (maxx - minx) / 50, (maxy - miny) / 50
+    res = []
+    for _ in range(n):
+        x, y = rnd.uniform(minx, maxx - w), rnd.uniform(miny, maxy - h)
+        res.append(box(x, y, x + w, y + h))
+    return res
+
+
+def scan(features, aoi):
+    return [f for f in features if shape(f['geometry']).intersects(aoi)]
+
+
+def main():
+    for type_id, grid_vector in GRIDS_BY_TYPE.items():
+        if not os.path.exists(grid_vector):
+            print(f"{type_id}: {grid_vector} not found, skipping")
+            continue
+
+        with fiona.open(grid_vector) as src:
+            features = list(src)
+            bounds = src.bounds
+        aois = random_aois(bounds, NUM_AOIS)
+
+        grid = load_grid_index(grid_vector)
+        for aoi in aois:
+            assert len(scan(features, aoi)) == len(grid.query(aoi))
+
+        t_scan = min(
+            timeit.repeat(lambda: [scan(features, aoi) for aoi in aois],
+                          number=1,
+                          repeat=REPEAT))
+        t_index = min(
+            timeit.repeat(lambda: [grid.query(aoi) for aoi in aois],
+                          number=1,
+                          repeat=REPEAT))
+
+        print(f"{type_id} ({len(features)} cells, {NUM_AOIS} AOIs): "
+              f"scan {t_scan * 1000:.1f} ms, index {t_index * 1000:.1f} ms "
+              f"({t_scan / t_index:.1f}x)")
+
+
+if __name__ == '__main__':
+    main()
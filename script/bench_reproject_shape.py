@@ -0,0 +1,61 @@
+#!/usr/bin/env python3
+"""
+This internal script benchmarks reproject_shape on a large multipolygon
+(EPSG:4326 to EPSG:5381), comparing point by point reprojection with
+shapely.ops.transform against the array-based implementation.
+
+"""
+import timeit
+
+import numpy as np
+import pyproj
+from shapely.geometry import MultiPolygon, Polygon
+from shapely.ops import transform
+
+from ideuy.vector import reproject_shape
+
+NUM_POLYGONS = 100
+NUM_VERTICES = 10000
+REPEAT = 3
+
+
+def build_multipolygon():
+    # Circles around Montevideo, with many vertices each
+    angles = np.linspace(0, 2 * np.pi, NUM_VERTICES, endpoint=False)
+    polys = []
+    for i in range(NUM_POLYGONS):
+        cx, cy = -56.2 + (i % 10) * 0.02, -34.9 + (i // 10) * 0.02
+        polys.append(
+            Polygon(
+                np.column_stack([
+                    cx + 0.005 * np.cos(angles), cy + 0.005 * np.sin(angles)
+                ])))
+    return MultiPolygon(polys)
+
+
+def reproject_shape_pointwise(shp, from_crs, to_crs):
+    transformer = pyproj.Transformer.from_crs(from_crs,
+                                              to_crs,
+                                              always_xy=True)
+    return transform(transformer.transform, shp)
+
+
+def main():
+    shp = build_multipolygon()
+    num_coords = NUM_POLYGONS * (NUM_VERTICES + 1)
+
+    a = reproject_shape_pointwise(shp, 'epsg:4326', 'epsg:5381')
+    b = reproject_shape(shp, 'epsg:4326', 'epsg:5381')
+    assert a.equals_exact(b, 1e-9)
+
+    for name, func in [('pointwise', reproject_shape_pointwise),
+                       ('array', reproject_shape)]:
+        t = min(
+            timeit.repeat(lambda: func(shp, 'epsg:4326', 'epsg:5381'),
+                          number=1,
+                          repeat=REPEAT))
+        print(f"{name}: {t * 1000:.1f} ms ({num_coords} coordinates)")
+
+
+if __name__ == '__main__':
+    main()
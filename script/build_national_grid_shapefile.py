@@ -5,7 +5,8 @@ grid shapefile.  Each feature represents each image ("hoja") and has a
 'data_path' property with the path where the image is stored in the data
 repository at IDE.
 
-The resulting shapefile is already included in the ideuy package.
+The resulting GeoJSON and its grid index are already included in the ideuy
+package.
 
 """
 import os
@@ -13,6 +14,7 @@ import os
 import fiona
 
 from ideuy.download import BASE_HOST, DATA_PATH, download_grid
+from ideuy.grid import INDEX_EXT, build_grid_index
 
 
 def create_national_grid_geojson(*, original_grid, output_dir):
@@ -50,6 +52,10 @@ def main():
                                             output_dir=output_dir)
     print("New national grid shapefile written at:", new_grid)
 
+    # Build grid index, to be shipped along with the grid GeoJSON
+    index = build_grid_index(new_grid, f'{new_grid}.{INDEX_EXT}')
+    print("Grid index written at:", index)
+
 
 if __name__ == '__main__':
     main()
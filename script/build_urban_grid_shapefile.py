@@ -4,7 +4,8 @@ This internal script fixes the reference grid GeoJSON for the Urban ortoimage.
 Each feature represents each image ("hoja") and has a 'data_path' property with
 the path where the image is stored in the data repository at IDE.
 
-The resulting GeoJSON is already included in the ideuy package.
+The resulting GeoJSON and its grid index are already included in the ideuy
+package.
 
 Requirements:
 - ideuy
@@ -23,6 +24,7 @@ from bs4 import BeautifulSoup
 from shapely.geometry import shape
 
 from ideuy.download import BASE_HOST, DATA_PATH, download_grid
+from ideuy.grid import INDEX_EXT, build_grid_index
 
 IMAGE_FORMAT_PATH = '02_RGBI_8bits'
 
@@ -118,6 +120,10 @@ def main():
                                          output_dir=output_dir)
     print("New urban grid shapefile written at:", new_grid)
 
+    # Build grid index, to be shipped along with the grid GeoJSON
+    index = build_grid_index(new_grid, f'{new_grid}.{INDEX_EXT}')
+    print("Grid index written at:", index)
+
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,359 @@
+"""
+asyncio download engine, based on aiohttp.
+
+Instead of one blocking request per thread, all downloads run concurrently
+on a single event loop, bounded by a semaphore, which allows to keep
+hundreds of requests in flight from a single process.
+
+Requires aiohttp (install with `pip install ideuy[async]`).
+
+"""
+import asyncio
+import logging
+import os
+import time
+from functools import partial
+
+from ideuy.download import (PART_EXT, PARTS_STATE_EXT,
+                            IncompleteDownloadError, RemoteFileChangedError,
+                            adopt_legacy_download, check_download_size,
+                            check_remote_file, finalize_download,
+                            get_chunk_size, get_download_size,
+                            get_metadata_cache, get_output_path,
+                            get_resume_headers)
+from ideuy.manifest import get_manifest
+from ideuy.metrics import RequestTimer
+from ideuy.progress import Progress
+from ideuy.retry import (DEFAULT_MAX_RETRIES, RETRY_STATUS_CODES,
+                         get_backoff_delay, get_rate_limiter,
+                         parse_retry_after)
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+_logger = logging.getLogger(__name__)
+
+
+def is_retryable_error(err):
+    """asyncio version of ideuy.download.is_retryable_error"""
+    if isinstance(err, aiohttp.ClientResponseError):
+        return err.status in RETRY_STATUS_CODES
+    return isinstance(
+        err, (aiohttp.ClientConnectionError, aiohttp.ClientPayloadError,
+              asyncio.TimeoutError, IncompleteDownloadError))
+
+
+async def call_with_retries_async(func,
+                                  *,
+                                  max_retries=DEFAULT_MAX_RETRIES,
+                                  on_retry=None,
+                                  description=None):
+    """asyncio version of ideuy.retry.call_with_retries"""
+    attempt = 0
+    while True:
+        try:
+            return await func()
+        except Exception as err:
+            if attempt >= max_retries or not is_retryable_error(err):
+                raise
+            retry_after = None
+            if isinstance(err, aiohttp.ClientResponseError) and err.headers:
+                retry_after = parse_retry_after(err.headers.get('Retry-After'))
+            delay = get_backoff_delay(attempt, retry_after=retry_after)
+            _logger.warning(f"{description or func} failed ({err!r}). "
+                            f"Retrying in {delay:.1f}s "
+                            f"({attempt + 1}/{max_retries})")
+            if on_retry:
+                on_retry(err)
+            await asyncio.sleep(delay)
+            attempt += 1
+
+
+async def run_blocking(func, *args, **kwargs):
+    """
+    Runs a blocking function (e.g. disk or cache I/O) in the default
+    executor, so that it does not stall the other downloads of the event
+    loop.
+
+    """
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(None, partial(func, *args, **kwargs))
+
+
+def remove_files(paths):
+    for path in paths:
+        if os.path.exists(path):
+            os.remove(path)
+
+
+async def wait_rate_limit(url, rate_limit):
+    limiter = get_rate_limiter(url, rate_limit)
+    if limiter:
+        await asyncio.sleep(limiter.reserve())
+
+
+async def get_url_metadata_async(session,
+                                 url,
+                                 use_cache=True,
+                                 refresh=False,
+                                 max_retries=DEFAULT_MAX_RETRIES,
+                                 rate_limit=None,
+                                 metrics=None):
+    """asyncio version of ideuy.download.get_url_metadata"""
+    cache = await run_blocking(get_metadata_cache) if use_cache else None
+    if cache and not refresh:
+        meta = await run_blocking(cache.get, url)
+        if meta is not None:
+            return meta
+
+    async def head():
+        await wait_rate_limit(url, rate_limit)
+        with RequestTimer('HEAD', url, metrics=metrics) as timer:
+            async with session.head(url, allow_redirects=True) as res:
+                timer.response(res.status)
+                res.raise_for_status()
+                return res.headers
+
+    headers = await call_with_retries_async(
+        head,
+        max_retries=max_retries,
+        on_retry=metrics.add_retry if metrics else None,
+        description=f"HEAD {url}")
+    meta = dict(size=int(headers.get('Content-Length', -1)),
+                etag=headers.get('ETag'),
+                last_modified=headers.get('Last-Modified'))
+
+    if cache:
+        await run_blocking(cache.set, url, meta)
+    return meta
+
+
+async def download_from_url_async(session,
+                                  url,
+                                  output_dir,
+                                  file_size=None,
+                                  flatten=True,
+                                  use_cache=True,
+                                  chunk_size=None,
+                                  max_retries=DEFAULT_MAX_RETRIES,
+                                  rate_limit=None,
+                                  checksum=False,
+                                  path_locks=None,
+                                  progress=None,
+                                  metrics=None):
+    """
+    asyncio version of ideuy.download.download_from_url
+
+    path_locks is an optional dict of asyncio.Lock by destination path, used
+    to avoid downloading the same file concurrently.
+
+    Connection setup is not timed separately in metrics, so it is included
+    in the time to first byte of requests.
+
+    """
+    _logger.info(f"Download {url} to {output_dir}")
+
+    dst = get_output_path(url, output_dir, flatten=flatten)
+    if path_locks is not None:
+        lock = path_locks.setdefault(os.path.abspath(dst), asyncio.Lock())
+        async with lock:
+            return await download_from_url_async(session,
+                                                 url,
+                                                 output_dir,
+                                                 file_size=file_size,
+                                                 flatten=flatten,
+                                                 use_cache=use_cache,
+                                                 chunk_size=chunk_size,
+                                                 max_retries=max_retries,
+                                                 rate_limit=rate_limit,
+                                                 checksum=checksum,
+                                                 progress=progress,
+                                                 metrics=metrics)
+
+    # Disk and cache I/O (including checksums of large files) run in
+    # threads, so that they do not block the event loop
+    manifest = await run_blocking(get_manifest, output_dir)
+    if await run_blocking(manifest.is_complete,
+                          dst,
+                          size=file_size,
+                          verify=True,
+                          checksum=checksum):
+        return dst, manifest.get(dst)['size']
+
+    part_path = f'{dst}.{PART_EXT}'
+    state_path = f'{part_path}.{PARTS_STATE_EXT}'
+    if await run_blocking(os.path.exists, state_path):
+        # Multi-part downloads of the thread engine can not be resumed here,
+        # and their .part file is preallocated, so start over.
+        _logger.warning(f"Discard interrupted multi-part download of {dst}")
+        await run_blocking(remove_files, (part_path, state_path))
+
+    async def download(refresh=False):
+        meta = await get_url_metadata_async(session,
+                                            url,
+                                            use_cache=use_cache,
+                                            refresh=refresh,
+                                            max_retries=max_retries,
+                                            rate_limit=rate_limit,
+                                            metrics=metrics)
+        size = get_download_size(file_size, meta)
+        if await run_blocking(adopt_legacy_download,
+                              dst,
+                              size,
+                              manifest=manifest,
+                              meta=meta):
+            return size
+
+        chunk = chunk_size or get_chunk_size(size)
+        await run_blocking(os.makedirs, os.path.dirname(dst), exist_ok=True)
+
+        async def transfer():
+            # Resume from the bytes already written, also on retries
+            resume = await run_blocking(get_resume_headers,
+                                        part_path,
+                                        size,
+                                        etag=meta['etag'])
+            if resume is None:
+                return
+            first_byte, header = resume
+            await wait_rate_limit(url, rate_limit)
+            with RequestTimer('GET', url, metrics=metrics) as timer:
+                async with session.get(url, headers=header) as res:
+                    timer.response(res.status)
+                    res.raise_for_status()
+                    check_remote_file(url,
+                                      res.status,
+                                      res.headers,
+                                      size=meta['size'],
+                                      etag=meta['etag'])
+                    mode = 'ab'
+                    if res.status != 206:
+                        # Server is sending the whole file (Range header
+                        # ignored)
+                        first_byte, mode = 0, 'wb'
+                    written = 0
+                    f = await run_blocking(open, part_path, mode)
+                    try:
+                        start = time.perf_counter()
+                        async for data in res.content.iter_chunked(chunk):
+                            read = time.perf_counter()
+                            await run_blocking(f.write, data)
+                            written += len(data)
+                            if progress:
+                                progress.add_bytes(len(data))
+                            timer.add('transfer', read - start)
+                            timer.add('bytes', len(data))
+                            start = time.perf_counter()
+                            timer.add('write', start - read)
+                    finally:
+                        await run_blocking(f.close)
+            check_download_size(first_byte + written, size)
+
+        await call_with_retries_async(
+            transfer,
+            max_retries=max_retries,
+            on_retry=metrics.add_retry if metrics else None,
+            description=f"GET {url}")
+
+        await run_blocking(finalize_download,
+                           part_path,
+                           dst,
+                           manifest=manifest,
+                           meta=meta,
+                           checksum=checksum)
+        return size
+
+    try:
+        file_size = await download()
+    except RemoteFileChangedError as err:
+        # Bytes already downloaded are from an older version of the file
+        _logger.warning(f"{err}. Downloading it again")
+        await run_blocking(remove_files, (part_path, ))
+        file_size = await download(refresh=True)
+    return dst, file_size
+
+
+async def download_all_async(urls,
+                             num_jobs=1,
+                             file_size=None,
+                             flatten=True,
+                             max_retries=DEFAULT_MAX_RETRIES,
+                             rate_limit=None,
+                             checksum=False,
+                             total=None,
+                             total_size=None,
+                             progress_json=False,
+                             metrics=None,
+                             *,
+                             output_dir):
+    """
+    Download all URLs concurrently, with at most num_jobs downloads in
+    flight at the same time.
+
+    urls can be any iterable, e.g. a generator of URLs of products being
+    queried. It is consumed lazily, in a worker thread, so that downloads
+    start as soon as the first URLs are available.
+
+    Progress is reported over total URLs and total_size bytes, if known.
+
+    """
+    if aiohttp is None:
+        raise RuntimeError("aiohttp is required for the asyncio engine. "
+                           "Please install it with `pip install ideuy[async]`")
+
+    loop = asyncio.get_running_loop()
+    if total is None and hasattr(urls, '__len__'):
+        total = len(urls)
+    urls = iter(urls)
+
+    semaphore = asyncio.Semaphore(num_jobs)
+    connector = aiohttp.TCPConnector(limit=num_jobs)
+    timeout = aiohttp.ClientTimeout(total=None, sock_read=60)
+
+    async with aiohttp.ClientSession(connector=connector,
+                                     timeout=timeout) as session:
+        pending = set()
+        path_locks = {}
+        try:
+            with Progress(total_files=total,
+                          total_bytes=total_size,
+                          json=progress_json) as progress:
+
+                def on_done(task):
+                    semaphore.release()
+                    # Only count completed downloads
+                    if not task.cancelled() and task.exception() is None:
+                        progress.add_file()
+
+                while True:
+                    url = await loop.run_in_executor(None, next, urls, None)
+                    if url is None:
+                        break
+                    await semaphore.acquire()
+                    task = asyncio.ensure_future(
+                        download_from_url_async(session,
+                                                url,
+                                                output_dir,
+                                                file_size=file_size,
+                                                flatten=flatten,
+                                                max_retries=max_retries,
+                                                rate_limit=rate_limit,
+                                                checksum=checksum,
+                                                path_locks=path_locks,
+                                                progress=progress,
+                                                metrics=metrics))
+                    task.add_done_callback(on_done)
+                    pending.add(task)
+
+                    # Raise errors of finished downloads, if any
+                    for task in [t for t in pending if t.done()]:
+                        pending.discard(task)
+                        task.result()
+
+                for fut in asyncio.as_completed(pending):
+                    await fut
+        finally:
+            for task in pending:
+                task.cancel()
@@ -0,0 +1,107 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+
+CACHE_DIR = os.environ.get(
+    'IDEUY_CACHE_DIR', os.path.join(os.path.expanduser('~'), '.cache',
+                                    'ideuy'))
+
+
+def get_cache_path(*parts):
+    """Returns a path inside the cache directory, creating parent dirs"""
+    path = os.path.join(CACHE_DIR, *parts)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    return path
+
+
+class Cache:
+    """
+    Persistent key-value cache stored in a SQLite database.
+
+    Values are serialized as JSON.  Entries older than `ttl` seconds are
+    considered expired (never, if `ttl` is None).  If `max_size` is set, the
+    oldest entries are evicted when the total size of serialized values
+    exceeds `max_size` bytes.  A cache can be shared between threads and
+    processes.
+
+    """
+    def __init__(self, path, ttl=None, max_size=None):
+        self.path = path
+        self.ttl = ttl
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path,
+                                     timeout=30,
+                                     isolation_level=None,
+                                     check_same_thread=False)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('CREATE TABLE IF NOT EXISTS cache ('
+                           'key TEXT PRIMARY KEY, '
+                           'value TEXT NOT NULL, '
+                           'created_at REAL NOT NULL)')
+
+    def lookup(self, key):
+        """
+        Returns a tuple (value, expired) for key, or None if missing.
+
+        Expired entries are kept until evicted, so that they can be
+        revalidated.
+
+        """
+        with self._lock:
+            row = self._conn.execute(
+                'SELECT value, created_at FROM cache WHERE key = ?',
+                (key, )).fetchone()
+        if row is None:
+            return None
+        value, created_at = row
+        expired = self.ttl is not None and time.time() - created_at > self.ttl
+        return json.loads(value), expired
+
+    def get(self, key):
+        """Returns value for key, or None if missing or expired"""
+        res = self.lookup(key)
+        if res is None or res[1]:
+            return None
+        return res[0]
+
+    def set(self, key, value):
+        with self._lock:
+            self._conn.execute(
+                'INSERT OR REPLACE INTO cache (key, value, created_at) '
+                'VALUES (?, ?, ?)', (key, json.dumps(value), time.time()))
+            if self.max_size is not None:
+                self._evict()
+
+    def touch(self, key):
+        """Renews an entry, e.g. after it was revalidated"""
+        with self._lock:
+            self._conn.execute(
+                'UPDATE cache SET created_at = ? WHERE key = ?',
+                (time.time(), key))
+
+    def _evict(self):
+        total, = self._conn.execute(
+            'SELECT COALESCE(SUM(LENGTH(value)), 0) FROM cache').fetchone()
+        if total <= self.max_size:
+            return
+        rows = self._conn.execute(
+            'SELECT key, LENGTH(value) FROM cache ORDER BY created_at'
+        ).fetchall()
+        evicted = []
+        for key, size in rows:
+            if total <= self.max_size:
+                break
+            evicted.append((key, ))
+            total -= size
+        self._conn.executemany('DELETE FROM cache WHERE key = ?', evicted)
+
+    def delete(self, key):
+        with self._lock:
+            self._conn.execute('DELETE FROM cache WHERE key = ?', (key, ))
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
@@ -20,7 +20,6 @@ import logging
 import sys
 
 from ideuy import __version__
-from ideuy.download import download_images_from_grid_vector
 
 __author__ = "Damián Silvani"
 __copyright__ = "Damián Silvani"
@@ -60,6 +59,58 @@ def parse_args(args):
                         default=1,
                         type=int,
                         help="number of simultaneous download threads")
+    parser.add_argument("--num-parts",
+                        default=1,
+                        type=int,
+                        help="number of byte ranges to download "
+                        "simultaneously for each file")
+    parser.add_argument("--engine",
+                        default="thread",
+                        choices=["thread", "asyncio"],
+                        help="download engine (asyncio requires aiohttp, "
+                        "and does not support --num-parts)")
+    parser.add_argument("--max-retries",
+                        default=5,
+                        type=int,
+                        help="max number of retries of failed requests")
+    parser.add_argument("--rate-limit",
+                        default=None,
+                        type=float,
+                        help="max number of requests per second to each host")
+    parser.add_argument("--checksum",
+                        action="store_true",
+                        help="store SHA-256 checksums of downloaded files "
+                        "in the output dir manifest, and verify completed "
+                        "files against them")
+
+    parser.add_argument("--plan",
+                        action="store_true",
+                        help="discover sizes of all files before downloading, "
+                        "and download largest files first")
+    parser.add_argument("--dry-run",
+                        action="store_true",
+                        help="only discover sizes of all files, and print "
+                        "total size to download")
+    parser.add_argument("--job-store",
+                        default=None,
+                        help="path to a job store (SQLite database) to track "
+                        "downloads, and resume them if interrupted")
+    parser.add_argument("--worker",
+                        action="store_true",
+                        help="claim jobs from the job store, shared with "
+                        "other worker processes (possibly on other hosts, "
+                        "with a shared filesystem). Requires --job-store.")
+    parser.add_argument("--progress-json",
+                        action="store_true",
+                        help="print progress as JSON lines (NDJSON) to "
+                        "stdout, instead of a progress bar. Logs are printed "
+                        "to stderr.")
+    parser.add_argument("--metrics-output",
+                        default=None,
+                        help="write request metrics (timings by phase, "
+                        "retries, bytes) to this path when done, as a "
+                        "Prometheus textfile if it ends with .prom, "
+                        "otherwise as JSON")
 
     parser.add_argument("--version",
                         action="version",
@@ -77,18 +128,22 @@ def parse_args(args):
                         action="store_const",
                         const=logging.DEBUG)
 
-    return parser.parse_args(args)
+    args = parser.parse_args(args)
+    if args.job_store and (args.plan or args.dry_run):
+        parser.error("--plan and --dry-run are not supported with --job-store")
+    return args
 
 
-def setup_logging(loglevel):
+def setup_logging(loglevel, stream=sys.stdout):
     """Setup basic logging
 
     Args:
       loglevel (int): minimum loglevel for emitting messages
+      stream: stream to write messages to
     """
     logformat = "[%(asctime)s] %(levelname)s:%(name)s:%(message)s"
     logging.basicConfig(level=loglevel,
-                        stream=sys.stdout,
+                        stream=stream,
                         format=logformat,
                         datefmt="%Y-%m-%d %H:%M:%S")
 
@@ -100,13 +155,36 @@ def main(args):
       args ([str]): command line parameter list
     """
     args = parse_args(args)
-    setup_logging(args.loglevel)
-
-    download_images_from_grid_vector(grid_vector=args.grid_vector,
-                                     output_dir=args.output_dir,
-                                     type_id=args.type,
-                                     product_type_id=args.product_type,
-                                     num_jobs=args.num_jobs)
+    # Keep stdout for progress events only
+    setup_logging(args.loglevel,
+                  stream=sys.stderr if args.progress_json else sys.stdout)
+
+    # Imported after parsing args, so that --help does not need to load
+    # heavy libraries
+    from ideuy.download import download_images_from_grid_vector
+
+    res = download_images_from_grid_vector(grid_vector=args.grid_vector,
+                                           output_dir=args.output_dir,
+                                           type_id=args.type,
+                                           product_type_id=args.product_type,
+                                           num_jobs=args.num_jobs,
+                                           num_parts=args.num_parts,
+                                           engine=args.engine,
+                                           max_retries=args.max_retries,
+                                           rate_limit=args.rate_limit,
+                                           checksum=args.checksum,
+                                           job_store=args.job_store,
+                                           worker=args.worker,
+                                           plan=args.plan,
+                                           dry_run=args.dry_run,
+                                           progress_json=args.progress_json,
+                                           metrics_output=args.metrics_output)
+
+    if args.dry_run:
+        pending = [f for f in res if not f['complete']]
+        size = sum(max(f['size'], 0) for f in pending)
+        print(f"{len(pending)} of {len(res)} files to download "
+              f"({size / 1024**2:.1f} MiB)")
 
 
 def run():
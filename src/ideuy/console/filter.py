@@ -20,7 +20,6 @@ import logging
 import sys
 
 from ideuy import __version__
-from ideuy.vector import filter_by_aoi
 
 __author__ = "Damián Silvani"
 __copyright__ = "Damián Silvani"
@@ -42,7 +41,10 @@ def parse_args(args):
         description="Filter by AOI",
         formatter_class=argparse.ArgumentDefaultsHelpFormatter)
 
-    parser.add_argument("aoi_vector", help="Path to AOI vector file")
+    parser.add_argument(
+        "aoi_vector",
+        help="Path to AOI vector file, or to a directory of AOI vector "
+        "files or a multi-layer AOI vector file if --batch is used")
     parser.add_argument("--type",
                         "-t",
                         default="national",
@@ -51,13 +53,41 @@ def parse_args(args):
     parser.add_argument("--output",
                         "-o",
                         required=True,
-                        help="Path to output GeoJSON vector file")
+                        help="Path to output GeoJSON vector file. "
+                        "With --batch, path to output directory, or to "
+                        "output CSV file if --table is used")
 
     parser.add_argument(
         "--grid-vector",
         default=None,
         help="Path to grid vector file. This overrides --type if specified.")
 
+    parser.add_argument(
+        "--simplify",
+        action="store_true",
+        help="Simplify AOI to grid resolution before filtering. "
+        "Much faster for very detailed AOIs, but may select a few more "
+        "cells along the AOI boundary.")
+
+    parser.add_argument(
+        "--batch",
+        action="store_true",
+        help="Filter by many AOIs, one per file in the aoi_vector "
+        "directory, or one per layer of the aoi_vector file. "
+        "Creates a filtered grid vector file for each AOI.")
+    parser.add_argument(
+        "--table",
+        action="store_true",
+        help="With --batch, write a single CSV table of (aoi_id, cell) "
+        "instead of one vector file per AOI")
+
+    parser.add_argument("-j",
+                        "--num-jobs",
+                        default=1,
+                        type=int,
+                        help="number of processes used to repair and merge "
+                        "AOI shapes")
+
     parser.add_argument("--version",
                         action="version",
                         version="ideuy {ver}".format(ver=__version__))
@@ -99,10 +129,25 @@ def main(args):
     args = parse_args(args)
     setup_logging(args.loglevel)
 
-    filter_by_aoi(args.aoi_vector,
-                  output=args.output,
-                  type_id=args.type,
-                  grid_vector=args.grid_vector)
+    # Imported after parsing args, so that --help does not need to load
+    # heavy libraries
+    from ideuy.vector import filter_by_aoi, filter_by_aois
+
+    if args.batch:
+        filter_by_aois(args.aoi_vector,
+                       simplify=args.simplify,
+                       num_jobs=args.num_jobs,
+                       table=args.table,
+                       output=args.output,
+                       type_id=args.type,
+                       grid_vector=args.grid_vector)
+    else:
+        filter_by_aoi(args.aoi_vector,
+                      simplify=args.simplify,
+                      num_jobs=args.num_jobs,
+                      output=args.output,
+                      type_id=args.type,
+                      grid_vector=args.grid_vector)
 
 
 def run():
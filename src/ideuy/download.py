@@ -1,17 +1,43 @@
+import asyncio
+import json
 import logging
 import os
+import socket
+import threading
+import time
+from collections import defaultdict
 from functools import partial
 from multiprocessing.pool import ThreadPool
 from urllib.parse import urlparse
-from urllib.request import urlopen
 
-import fiona
 import requests
-from tqdm import tqdm
+import urllib3
+from requests.adapters import HTTPAdapter
+
+from ideuy.cache import Cache, get_cache_path
+from ideuy.jobs import DONE, FAILED, JobStore
+from ideuy.manifest import file_checksum, get_manifest
+from ideuy.metrics import (POOL_CLASSES_BY_SCHEME, RequestTimer,
+                           collect_metrics)
+from ideuy.progress import Progress
+from ideuy.retry import (DEFAULT_MAX_RETRIES, RETRY_STATUS_CODES,
+                         call_with_retries, get_rate_limiter,
+                         parse_retry_after)
 
 BASE_HOST = 'https://visualizador.ide.uy'
 DATA_PATH = '/descargas/datos/'
 DEFAULT_CRS = 'epsg:4326'
+DEFAULT_POOL_SIZE = 10
+METADATA_CACHE_TTL = 24 * 60 * 60
+MIN_CHUNK_SIZE = 1024 * 1024
+MAX_CHUNK_SIZE = 8 * 1024 * 1024
+PART_EXT = 'part'
+PARTS_STATE_EXT = 'parts'
+ENGINES = ('thread', 'asyncio')
+# Maximum number of pending tasks per job, when feeding a pool lazily
+QUEUE_SIZE_FACTOR = 2
+# Seconds a worker waits before claiming again, when jobs are leased
+WORKER_POLL_INTERVAL = 10
 
 # deprecated: move to script/build_*
 GRID_SHP_EXTS = ['cpg', 'dbf', 'prj', 'shp', 'shx']
@@ -45,35 +71,558 @@ IMAGE_URL = f'{BASE_HOST}{DATA_PATH}' '{type_dir}/02_Ortoimagenes/{product_path}
 
 _logger = logging.getLogger(__name__)
 
+_session = None
+_session_lock = threading.Lock()
+_metadata_cache = None
+_metadata_cache_lock = threading.Lock()
+_path_locks = defaultdict(threading.Lock)
+_path_locks_lock = threading.Lock()
+
+
+class IncompleteDownloadError(RuntimeError):
+    pass
+
+
+class RemoteFileChangedError(RuntimeError):
+    pass
+
+
+class RateLimitedAdapter(HTTPAdapter):
+    """
+    HTTP adapter that limits the rate of requests sent to each host to
+    `rate_limit` requests per second (unlimited if None).
+
+    Connection setup times are recorded for request metrics (see
+    ideuy.metrics).
+
+    """
+    def __init__(self, rate_limit=None, **kwargs):
+        self.rate_limit = rate_limit
+        super().__init__(**kwargs)
+
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = POOL_CLASSES_BY_SCHEME
+
+    def send(self, request, **kwargs):
+        limiter = get_rate_limiter(request.url, self.rate_limit)
+        if limiter:
+            limiter.acquire()
+        return super().send(request, **kwargs)
+
+
+def create_session(pool_size=DEFAULT_POOL_SIZE, rate_limit=None):
+    """
+    Creates a requests session with a pool of keep-alive connections.
+
+    Sessions are safe to share between threads.  At most `pool_size`
+    connections per host are opened, so it should be at least the number
+    of threads using the session.  If `rate_limit` is set, requests to each
+    host are limited to that many requests per second.
+
+    """
+    session = requests.Session()
+    adapter = RateLimitedAdapter(rate_limit=rate_limit,
+                                 pool_connections=pool_size,
+                                 pool_maxsize=pool_size,
+                                 pool_block=True)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+def get_session():
+    """Returns the default shared session, creating it if needed"""
+    global _session
+    with _session_lock:
+        if _session is None:
+            _session = create_session()
+        return _session
+
+
+def is_retryable_error(err):
+    """
+    Returns whether err is a transient error (connection errors, timeouts,
+    errors while streaming a body, and some HTTP 4xx/5xx status codes)
+
+    """
+    if isinstance(err, requests.HTTPError):
+        return err.response is not None and \
+            err.response.status_code in RETRY_STATUS_CODES
+    return isinstance(
+        err, (requests.ConnectionError, requests.Timeout,
+              requests.exceptions.ChunkedEncodingError,
+              urllib3.exceptions.HTTPError, ConnectionError, TimeoutError,
+              IncompleteDownloadError))
+
+
+def get_error_retry_after(err):
+    if isinstance(err, requests.HTTPError) and err.response is not None:
+        return parse_retry_after(err.response.headers.get('Retry-After'))
+    return None
+
+
+def request_with_retries(func,
+                         description,
+                         max_retries=DEFAULT_MAX_RETRIES,
+                         metrics=None):
+    return call_with_retries(func,
+                             is_retryable=is_retryable_error,
+                             get_retry_after=get_error_retry_after,
+                             max_retries=max_retries,
+                             on_retry=metrics.add_retry if metrics else None,
+                             description=description)
+
+
+def get_metadata_cache():
+    """Returns the URL metadata cache, creating it if needed"""
+    global _metadata_cache
+    with _metadata_cache_lock:
+        if _metadata_cache is None:
+            _metadata_cache = Cache(get_cache_path('metadata.sqlite'),
+                                    ttl=METADATA_CACHE_TTL)
+        return _metadata_cache
+
+
+def get_url_metadata(url,
+                     session=None,
+                     use_cache=True,
+                     refresh=False,
+                     max_retries=DEFAULT_MAX_RETRIES,
+                     metrics=None):
+    """
+    Returns a dict with size, ETag and Last-Modified of a remote file.
+
+    Metadata is fetched with a HEAD request, and stored in the metadata
+    cache, so that subsequent calls within the cache TTL do not hit the
+    server.  If refresh is true, it is fetched again, and updated in the
+    cache.
+
+    """
+    cache = get_metadata_cache() if use_cache else None
+    if cache and not refresh:
+        meta = cache.get(url)
+        if meta is not None:
+            return meta
+
+    if session is None:
+        session = get_session()
+
+    def head():
+        with RequestTimer('HEAD', url, metrics=metrics) as timer:
+            res = session.head(url, allow_redirects=True)
+            timer.response(res.status_code)
+            res.raise_for_status()
+        return res
+
+    res = request_with_retries(head,
+                               f"HEAD {url}",
+                               max_retries=max_retries,
+                               metrics=metrics)
+    meta = dict(size=int(res.headers.get('Content-Length', -1)),
+                etag=res.headers.get('ETag'),
+                last_modified=res.headers.get('Last-Modified'))
+
+    if cache:
+        cache.set(url, meta)
+    return meta
+
+
+class BoundedIterator:
+    """
+    Iterator that lets at most `size` items from iterable be in flight,
+    i.e. taken but not marked as done yet.
+
+    Used to feed a pool lazily: the pool blocks on taking new items until
+    previous ones are done, instead of consuming the whole iterable.
+
+    """
+    def __init__(self, iterable, size):
+        self._it = iter(iterable)
+        self._semaphore = threading.Semaphore(size)
+        self._closed = False
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        self._semaphore.acquire()
+        if self._closed:
+            raise StopIteration
+        return next(self._it)
+
+    def done(self):
+        """Marks an item as done"""
+        self._semaphore.release()
+
+    def close(self):
+        """Stops iteration, e.g. to unblock the pool when it is terminated"""
+        self._closed = True
+        self._semaphore.release()
+
+
+def imap_bounded(pool, func, iterable, size):
+    """
+    Like pool.imap_unordered, but consuming iterable lazily, with at most
+    size items queued or running at the same time.
+
+    """
+    items = BoundedIterator(iterable, size)
+    try:
+        for res in pool.imap_unordered(func, items):
+            items.done()
+            yield res
+    finally:
+        items.close()
+
+
+def get_path_lock(path):
+    """Returns a lock for a destination path, shared by all threads"""
+    with _path_locks_lock:
+        return _path_locks[os.path.abspath(path)]
+
+
+def get_chunk_size(file_size):
+    """Returns a streaming chunk size (between 1 and 8 MiB) for file_size"""
+    return min(max(file_size // 64, MIN_CHUNK_SIZE), MAX_CHUNK_SIZE)
+
+
+def copy_response(res, f, chunk_size, callback=None, timer=None):
+    """
+    Copies the body of a streamed response into a file object.
+
+    If body is not encoded, it is read straight from the raw stream into a
+    preallocated buffer, otherwise it is decoded by requests.  `callback` is
+    called with the number of bytes written after each chunk.  If timer is
+    set (see ideuy.metrics.RequestTimer), time spent reading from the
+    network and writing to f, and bytes written, are added to it.
+
+    Returns the total number of bytes written.
+
+    """
+    total = 0
+    transfer_time = write_time = 0
+    clock = time.perf_counter
+    try:
+        if res.headers.get('Content-Encoding', 'identity') == 'identity':
+            buf = bytearray(chunk_size)
+            view = memoryview(buf)
+            while True:
+                start = clock()
+                n = res.raw.readinto(buf)
+                read = clock()
+                transfer_time += read - start
+                if not n:
+                    break
+                f.write(view[:n])
+                write_time += clock() - read
+                total += n
+                if callback:
+                    callback(n)
+        else:
+            start = clock()
+            for chunk in res.iter_content(chunk_size=chunk_size):
+                read = clock()
+                transfer_time += read - start
+                f.write(chunk)
+                start = clock()
+                write_time += start - read
+                total += len(chunk)
+                if callback:
+                    callback(len(chunk))
+    finally:
+        if timer:
+            timer.add('transfer', transfer_time)
+            timer.add('write', write_time)
+            timer.add('bytes', total)
+    return total
+
 
 def download_images_from_grid_vector(grid_vector,
                                      num_jobs=1,
+                                     num_parts=1,
+                                     engine='thread',
+                                     max_retries=DEFAULT_MAX_RETRIES,
+                                     rate_limit=None,
+                                     checksum=False,
+                                     job_store=None,
+                                     worker=False,
+                                     plan=False,
+                                     dry_run=False,
+                                     progress_json=False,
+                                     metrics=None,
+                                     metrics_output=None,
                                      *,
                                      output_dir,
                                      type_id,
                                      product_type_id):
-    with fiona.open(grid_vector) as src:
-        features = list(src)
+    """
+    Download image files of all cells of a grid vector (see download_all).
+
+    If job_store is the path of a job store (see ideuy.jobs), downloads are
+    tracked there, and only jobs that are not done yet are run, so that an
+    interrupted download can be resumed from pending jobs.  If worker is
+    true, jobs are claimed from the job store, shared with other workers
+    (see download_grid_jobs).
+
+    """
+    import fiona
+
+    if engine not in ENGINES:
+        raise RuntimeError(f"Invalid engine. Should be one of {ENGINES}")
+
+    if worker and not job_store:
+        raise RuntimeError("Worker mode requires a job store")
+
+    if job_store:
+        if engine != 'thread':
+            raise RuntimeError(
+                "Job store is only supported with the thread engine")
+        if plan or dry_run:
+            raise RuntimeError("Planning is not supported with a job store")
+        return download_grid_jobs(grid_vector,
+                                  job_store,
+                                  num_jobs=num_jobs,
+                                  num_parts=num_parts,
+                                  max_retries=max_retries,
+                                  rate_limit=rate_limit,
+                                  checksum=checksum,
+                                  worker=worker,
+                                  progress_json=progress_json,
+                                  metrics=metrics,
+                                  metrics_output=metrics_output,
+                                  output_dir=output_dir,
+                                  type_id=type_id,
+                                  product_type_id=product_type_id)
+
+    # Only properties of grid cells are needed, so skip decoding geometries.
+    # Features are streamed from the file while downloading.
+    num_files = len(EXTS_BY_FORMAT[product_type_id])
+    with fiona.open(grid_vector, ignore_geometry=True) as src:
+        if engine == 'asyncio' or plan or dry_run:
+            urls = (url for feat in src for url in get_image_urls(
+                type_id=type_id,
+                product_type_id=product_type_id,
+                data_path=feat['properties']['data_path'],
+                coord=feat['properties']['Nombre']))
+            return download_all(urls,
+                                num_jobs=num_jobs,
+                                num_parts=num_parts,
+                                engine=engine,
+                                max_retries=max_retries,
+                                rate_limit=rate_limit,
+                                checksum=checksum,
+                                total=len(src) * num_files,
+                                plan=plan,
+                                dry_run=dry_run,
+                                progress_json=progress_json,
+                                metrics=metrics,
+                                metrics_output=metrics_output,
+                                output_dir=output_dir)
+
+        with collect_metrics(metrics, metrics_output) as metrics, \
+                create_session(pool_size=num_jobs * num_parts,
+                               rate_limit=rate_limit) as session, \
+                ThreadPool(num_jobs) as pool, \
+                Progress(total_files=len(src) * num_files,
+                         json=progress_json) as progress:
+            func = partial(download_feature_image,
+                           output_dir=output_dir,
+                           type_id=type_id,
+                           product_type_id=product_type_id,
+                           session=session,
+                           num_parts=num_parts,
+                           max_retries=max_retries,
+                           checksum=checksum,
+                           progress=progress,
+                           metrics=metrics)
+            for res in imap_bounded(pool, func, src,
+                                    num_jobs * QUEUE_SIZE_FACTOR):
+                progress.add_file(len(res))
+
+
+def download_grid_jobs(grid_vector,
+                       job_store,
+                       num_jobs=1,
+                       num_parts=1,
+                       max_retries=DEFAULT_MAX_RETRIES,
+                       rate_limit=None,
+                       checksum=False,
+                       worker=False,
+                       progress_json=False,
+                       metrics=None,
+                       metrics_output=None,
+                       *,
+                       output_dir,
+                       type_id,
+                       product_type_id):
+    """
+    Download image files of all cells of a grid vector, tracking each file
+    as a job in the job store at path job_store.
+
+    Jobs are added from the grid vector, and then only jobs that are not
+    done are downloaded.  Failed jobs are recorded, and retried on the next
+    run.
+
+    If worker is true, jobs are claimed from the job store, which can be
+    shared with other workers, in other processes or hosts (see
+    run_jobs_worker).
+
+    Requests are recorded in metrics, and written to metrics_output, if set
+    (see download_images_from_grid_vector).
+
+    """
+    store = JobStore(job_store)
+    try:
+        add_grid_jobs(store,
+                      grid_vector,
+                      type_id=type_id,
+                      product_type_id=product_type_id)
+
+        # Workers do not know in advance how many jobs they will claim
+        jobs = None
+        if not worker:
+            jobs = store.pending(product_type_id)
+            num_done, done_size = store.counts(product_type_id).get(
+                DONE, (0, 0))
+            _logger.info(f"{len(jobs)} pending jobs "
+                         f"({num_done} done, {done_size} bytes)")
 
-    with ThreadPool(num_jobs) as pool:
-        worker = partial(download_feature_image,
-                         output_dir=output_dir,
-                         type_id=type_id,
-                         product_type_id=product_type_id)
-        with tqdm(total=len(features)) as pbar:
-            for _ in enumerate(pool.imap_unordered(worker, features)):
-                pbar.update()
+        with collect_metrics(metrics, metrics_output) as metrics, \
+                create_session(pool_size=num_jobs * num_parts,
+                               rate_limit=rate_limit) as session, \
+                ThreadPool(num_jobs) as pool, \
+                Progress(total_files=len(jobs) if jobs is not None else None,
+                         json=progress_json) as progress:
+            func = partial(download_job,
+                           job_store=store,
+                           output_dir=output_dir,
+                           session=session,
+                           num_parts=num_parts,
+                           max_retries=max_retries,
+                           checksum=checksum,
+                           progress=progress,
+                           metrics=metrics)
+            if worker:
+                run_jobs_worker(store,
+                                func,
+                                pool,
+                                num_jobs=num_jobs,
+                                progress=progress,
+                                product_type_id=product_type_id)
+                failed, _ = store.counts(product_type_id).get(FAILED, (0, 0))
+            else:
+                failed = 0
+                for ok in imap_bounded(pool, func, jobs,
+                                       num_jobs * QUEUE_SIZE_FACTOR):
+                    failed += not ok
+                    progress.add_file()
+    finally:
+        store.close()
+
+    if failed:
+        raise RuntimeError(f"{failed} downloads failed. "
+                           "Run again with the same job store to retry them.")
+
+
+def add_grid_jobs(store, grid_vector, *, type_id, product_type_id):
+    """Adds a job to store for each image file of each cell of a grid"""
+    import fiona
+
+    with fiona.open(grid_vector, ignore_geometry=True) as src:
+        store.add((feat['properties']['Nombre'], product_type_id, url)
+                  for feat in src for url in get_image_urls(
+                      type_id=type_id,
+                      product_type_id=product_type_id,
+                      data_path=feat['properties']['data_path'],
+                      coord=feat['properties']['Nombre']))
+
+
+def run_jobs_worker(store,
+                    func,
+                    pool,
+                    num_jobs=1,
+                    progress=None,
+                    *,
+                    product_type_id):
+    """
+    Claims jobs of product_type_id from store, and runs them with func, in
+    num_jobs threads of pool, until there are no jobs left.
 
+    Leases of claimed jobs are renewed by a heartbeat thread while they run.
+    When there are no jobs left to claim, but other workers (or threads)
+    still hold leases, wait for them, as their jobs may fail or their leases
+    expire.  Waiting threads are woken up as soon as a job of this worker
+    finishes, and poll the store otherwise.
 
-def download_feature_image(feat, *, output_dir, type_id, product_type_id):
+    """
+    worker = f'{socket.gethostname()}:{os.getpid()}'
+    _logger.info(f"Start worker {worker}")
+    stop = threading.Event()
+    job_done = threading.Condition()
+
+    def heartbeat():
+        while not stop.wait(store.lease_duration / 3):
+            store.renew(worker)
+
+    def work(_):
+        while True:
+            job = store.claim(product_type_id, worker)
+            if job is None:
+                # Check leases while holding the lock, so that jobs finishing
+                # before waiting are not missed
+                with job_done:
+                    if not store.num_leased(product_type_id):
+                        return
+                    job_done.wait(WORKER_POLL_INTERVAL)
+                continue
+            try:
+                func(job)
+            finally:
+                with job_done:
+                    job_done.notify_all()
+            if progress:
+                progress.add_file()
+
+    heartbeat_thread = threading.Thread(target=heartbeat, daemon=True)
+    heartbeat_thread.start()
+    try:
+        pool.map(work, range(num_jobs))
+    finally:
+        stop.set()
+        heartbeat_thread.join()
+
+
+def download_job(job, *, job_store, output_dir, **kwargs):
+    """
+    Download the file of a job, and record the result in job_store.
+    Returns whether the download succeeded.
+
+    Extra keyword arguments are passed to download_from_url.
+
+    """
+    job_store.start(job['id'])
+    try:
+        _, size = download_from_url(job['url'], output_dir, **kwargs)
+    except Exception as err:
+        _logger.error(f"Download {job['url']} failed: {err!r}")
+        job_store.fail(job['id'], repr(err))
+        return False
+    job_store.finish(job['id'], size)
+    return True
+
+
+def download_feature_image(feat, *, output_dir, type_id, product_type_id,
+                           **kwargs):
     props = feat['properties']
     coord = props['Nombre']
     data_path = props['data_path']
-    download_image(output_dir=output_dir,
-                   type_id=type_id,
-                   product_type_id=product_type_id,
-                   data_path=data_path,
-                   coord=coord)
+    return download_image(output_dir=output_dir,
+                          type_id=type_id,
+                          product_type_id=product_type_id,
+                          data_path=data_path,
+                          coord=coord,
+                          **kwargs)
 
 
 def download_image(dry_run=False,
@@ -82,7 +631,39 @@ def download_image(dry_run=False,
                    type_id,
                    product_type_id,
                    data_path,
-                   coord):
+                   coord,
+                   **kwargs):
+    """
+    Download image files of a grid cell.
+
+    If dry_run is true, files are not downloaded, and their download plan
+    is returned instead (see plan_downloads).
+
+    Extra keyword arguments are passed to download_from_url.
+
+    """
+    urls = get_image_urls(type_id=type_id,
+                          product_type_id=product_type_id,
+                          data_path=data_path,
+                          coord=coord)
+    if dry_run:
+        return plan_downloads(urls,
+                              num_jobs=len(urls),
+                              flatten=kwargs.get('flatten', True),
+                              session=kwargs.get('session'),
+                              use_cache=kwargs.get('use_cache', True),
+                              max_retries=kwargs.get('max_retries',
+                                                     DEFAULT_MAX_RETRIES),
+                              metrics=kwargs.get('metrics'),
+                              output_dir=output_dir)
+    res = []
+    for url in urls:
+        res.append(download_from_url(url, output_dir, **kwargs))
+    return res
+
+
+def get_image_urls(*, type_id, product_type_id, data_path, coord):
+    """Returns the URLs of the image files of a grid cell"""
     if type_id not in ('national', 'urban'):
         raise RuntimeError(
             "Invalid type_id. Should be either 'national' or 'urban'")
@@ -115,85 +696,574 @@ def download_image(dry_run=False,
             url.replace('.jpg', '.jp2').replace('.jgw', '.j2w') for url in urls
         ]
 
-    res = []
-    for url in urls:
-        res.append(download_from_url(url, output_dir))
-    return res
+    return urls
 
 
 def download_all(urls,
                  num_jobs=1,
                  file_size=None,
                  flatten=True,
+                 num_parts=1,
+                 engine='thread',
+                 max_retries=DEFAULT_MAX_RETRIES,
+                 rate_limit=None,
+                 checksum=False,
+                 total=None,
+                 plan=False,
+                 dry_run=False,
+                 progress_json=False,
+                 metrics=None,
+                 metrics_output=None,
                  *,
                  output_dir):
-    with ThreadPool(num_jobs) as pool:
-        worker = partial(download_from_url,
-                         output_dir=output_dir,
-                         flatten=flatten,
-                         file_size=file_size)
-        with tqdm(total=len(urls)) as pbar:
-            for _ in enumerate(pool.imap_unordered(worker, urls)):
-                pbar.update()
+    """
+    Download all URLs, with up to num_jobs simultaneous downloads.
+
+    urls can be any iterable (e.g. a generator), consumed lazily as
+    downloads finish, and total is its length if it has none.  If plan is
+    true, files are sized first and downloaded largest first, and if
+    dry_run is true, only the plan is returned (see plan_downloads).
+    engine is either 'thread' or 'asyncio' (see ideuy.aio).
+
+    """
+    if engine not in ENGINES:
+        raise RuntimeError(f"Invalid engine. Should be one of {ENGINES}")
+    if engine == 'asyncio' and num_parts > 1:
+        raise RuntimeError(
+            "Multi-part downloads are not supported with the asyncio engine")
+
+    with collect_metrics(metrics, metrics_output) as metrics:
+        total_size = None
+        if plan or dry_run:
+            with create_session(pool_size=num_jobs,
+                                rate_limit=rate_limit) as session:
+                files = plan_downloads(urls,
+                                       num_jobs=num_jobs,
+                                       flatten=flatten,
+                                       session=session,
+                                       max_retries=max_retries,
+                                       total=total,
+                                       progress_json=progress_json,
+                                       metrics=metrics,
+                                       output_dir=output_dir)
+            if dry_run:
+                return files
+            files = [f for f in files if not f['complete']]
+            urls = [f['url'] for f in files]
+            total, total_size = len(files), sum(
+                max(f['size'], 0) for f in files)
+
+        if engine == 'asyncio':
+            from ideuy.aio import download_all_async
+            asyncio.run(
+                download_all_async(urls,
+                                   num_jobs=num_jobs,
+                                   file_size=file_size,
+                                   flatten=flatten,
+                                   max_retries=max_retries,
+                                   rate_limit=rate_limit,
+                                   checksum=checksum,
+                                   total=total,
+                                   total_size=total_size,
+                                   progress_json=progress_json,
+                                   metrics=metrics,
+                                   output_dir=output_dir))
+            return
+
+        if total is None and hasattr(urls, '__len__'):
+            total = len(urls)
+        # Planned downloads have a total size, so progress has an ETA
+        with create_session(pool_size=num_jobs * num_parts,
+                            rate_limit=rate_limit) as session, \
+                ThreadPool(num_jobs) as pool, \
+                Progress(total_files=total,
+                         total_bytes=total_size,
+                         json=progress_json) as progress:
+            worker = partial(download_from_url,
+                             output_dir=output_dir,
+                             flatten=flatten,
+                             file_size=file_size,
+                             session=session,
+                             num_parts=num_parts,
+                             max_retries=max_retries,
+                             checksum=checksum,
+                             progress=progress,
+                             metrics=metrics)
+            for _ in imap_bounded(pool, worker, urls,
+                                  num_jobs * QUEUE_SIZE_FACTOR):
+                progress.add_file()
+
+
+def plan_downloads(urls,
+                   num_jobs=1,
+                   flatten=True,
+                   session=None,
+                   use_cache=True,
+                   max_retries=DEFAULT_MAX_RETRIES,
+                   total=None,
+                   progress_json=False,
+                   metrics=None,
+                   *,
+                   output_dir):
+    """
+    Plan downloading URLs into output_dir.
+
+    The size of each file is discovered with num_jobs concurrent HEAD
+    requests (stored in the metadata cache, so that downloads do not request
+    them again).  Files already completed in the manifest of output_dir are
+    not requested.
+
+    Returns a list of dicts with url, size (-1 if unknown) and complete,
+    sorted by size, largest first.  This is the longest-processing-time
+    first order, which minimizes the time until the last download ends.
+
+    """
+    manifest = get_manifest(output_dir)
+
+    def probe(url):
+        dst = get_output_path(url, output_dir, flatten=flatten)
+        if manifest.is_complete(dst, verify=True):
+            return dict(url=url, size=manifest.get(dst)['size'], complete=True)
+        meta = get_url_metadata(url,
+                                session=session,
+                                use_cache=use_cache,
+                                max_retries=max_retries,
+                                metrics=metrics)
+        return dict(url=url, size=meta['size'], complete=False)
+
+    if total is None and hasattr(urls, '__len__'):
+        total = len(urls)
+    with ThreadPool(num_jobs) as pool, \
+            Progress(total_files=total,
+                     desc='Planning',
+                     json=progress_json,
+                     track_bytes=False) as progress:
+        files = []
+        for f in imap_bounded(pool, probe, urls, num_jobs * QUEUE_SIZE_FACTOR):
+            files.append(f)
+            progress.add_file()
+    files.sort(key=lambda f: f['size'], reverse=True)
+
+    pending = [f for f in files if not f['complete']]
+    pending_size = sum(max(f['size'], 0) for f in pending)
+    complete_size = sum(f['size'] for f in files if f['complete'])
+    _logger.info(f"Planned {len(files)} files: {len(pending)} to download "
+                 f"({pending_size} bytes), {len(files) - len(pending)} "
+                 f"already complete ({complete_size} bytes)")
+    return files
 
 
 # deprecated: move to script/build_*
-def download_grid(type_id, *, output_dir):
+def download_grid(type_id, *, output_dir, session=None):
     if type_id not in GRID_PATHS_BY_TYPE.keys():
         raise RuntimeError("type_id is invalid")
     base_url = f'{BASE_HOST}{DATA_PATH}{GRID_PATHS_BY_TYPE[type_id]}'
     res = None
     for ext in GRID_SHP_EXTS:
         url = f'{base_url}.{ext}'
-        output_path, _ = download_from_url(url, output_dir)
+        output_path, _ = download_from_url(url, output_dir, session=session)
         if ext == 'shp':
             res = output_path
     return res
 
 
-def download_from_url(url, output_dir, file_size=None, flatten=True):
+def get_output_path(url, output_dir, flatten=True):
+    """Returns the path where the file at url is downloaded to"""
+    # Extract path from url (without the leading slash)
+    path = urlparse(url).path[1:]
+    if flatten:
+        filename = path.split("/")[-1]
+        return os.path.join(output_dir, filename)
+    else:
+        return os.path.join(output_dir, path)
+
+
+def download_from_url(url,
+                      output_dir,
+                      file_size=None,
+                      flatten=True,
+                      session=None,
+                      use_cache=True,
+                      chunk_size=None,
+                      num_parts=1,
+                      max_retries=DEFAULT_MAX_RETRIES,
+                      checksum=False,
+                      progress=None,
+                      metrics=None):
     """
     Download from a URL
 
+    Files are downloaded into a .part file, which is renamed when complete,
+    and recorded in the manifest of the output directory.
+
     @param: url to download file
     @param: output_dir place to put the file
     @param: file_size specify the output file size, only downloads up to this point
     @param: flatten: keep original dir structure in URL or not
+    @param: session requests session to use (default: shared session)
+    @param: use_cache use cached file metadata, if available
+    @param: chunk_size streaming chunk size (default: based on file size)
+    @param: num_parts number of byte ranges to fetch concurrently
+    @param: max_retries max number of retries on transient errors
+    @param: checksum compute SHA-256 checksum and store it in the manifest
+    @param: progress Progress to add transferred bytes to
+    @param: metrics Metrics to record requests in
     """
     _logger.info(f"Download {url} to {output_dir}")
 
-    # Extract path from url (without the leading slash)
-    path = urlparse(url).path[1:]
-    if flatten:
-        filename = path.split("/")[-1]
-        dst = os.path.join(output_dir, filename)
-    else:
-        dst = os.path.join(output_dir, path)
+    dst = get_output_path(url, output_dir, flatten=flatten)
 
-    real_file_size = int(urlopen(url).info().get('Content-Length', -1))
-    if not file_size or file_size > real_file_size:
-        file_size = real_file_size
+    # Avoid downloading the same file concurrently (e.g. duplicate URLs)
+    with get_path_lock(dst):
+        # Files in the manifest are complete if they are still on disk, so
+        # skip them without any request to the server.
+        manifest = get_manifest(output_dir)
+        if manifest.is_complete(dst,
+                                size=file_size,
+                                verify=True,
+                                checksum=checksum):
+            return dst, manifest.get(dst)['size']
 
-    if os.path.exists(dst):
-        first_byte = os.path.getsize(dst)
-    else:
+        if session is None:
+            session = get_session()
+
+        part_path = f'{dst}.{PART_EXT}'
+        state_path = f'{part_path}.{PARTS_STATE_EXT}'
+
+        def download(refresh=False):
+            meta = get_url_metadata(url,
+                                    session=session,
+                                    use_cache=use_cache,
+                                    refresh=refresh,
+                                    max_retries=max_retries,
+                                    metrics=metrics)
+            size = get_download_size(file_size, meta)
+            if adopt_legacy_download(dst, size, manifest=manifest, meta=meta):
+                return meta, size
+
+            chunk = chunk_size or get_chunk_size(size)
+            os.makedirs(os.path.dirname(dst), exist_ok=True)
+            # A parts state file means that a multi-part download was
+            # interrupted, so resume it, regardless of num_parts.
+            use_parts = num_parts > 1 and \
+                size >= num_parts * MIN_CHUNK_SIZE and \
+                not os.path.exists(part_path)
+            if use_parts or os.path.exists(state_path):
+                download_parts(url,
+                               part_path,
+                               size,
+                               num_parts,
+                               session=session,
+                               chunk_size=chunk,
+                               max_retries=max_retries,
+                               remote_size=meta['size'],
+                               etag=meta['etag'],
+                               progress=progress,
+                               metrics=metrics)
+            else:
+                download_stream(url,
+                                part_path,
+                                size,
+                                session=session,
+                                chunk_size=chunk,
+                                max_retries=max_retries,
+                                remote_size=meta['size'],
+                                etag=meta['etag'],
+                                progress=progress,
+                                metrics=metrics)
+            finalize_download(part_path,
+                              dst,
+                              manifest=manifest,
+                              meta=meta,
+                              checksum=checksum)
+            return meta, size
+
+        try:
+            _, size = download()
+        except RemoteFileChangedError as err:
+            # Parts already downloaded are from an older version of the file
+            _logger.warning(f"{err}. Downloading it again")
+            for path in (part_path, state_path):
+                if os.path.exists(path):
+                    os.remove(path)
+            _, size = download(refresh=True)
+        return dst, size
+
+
+def get_download_size(file_size, meta):
+    """Returns the number of bytes to download, up to file_size if set"""
+    if not file_size or file_size > meta['size']:
+        return meta['size']
+    return file_size
+
+
+def adopt_legacy_download(dst, file_size, *, manifest, meta):
+    """
+    Records dst in the manifest if it was downloaded before manifests were
+    introduced, i.e. written directly at dst, with the expected size and no
+    .part file nor manifest record.  Returns whether it was.
+
+    """
+    part_path = f'{dst}.{PART_EXT}'
+    if manifest.get(dst) is None and os.path.exists(dst) and \
+            os.path.getsize(dst) == file_size and \
+            not os.path.exists(part_path) and \
+            not os.path.exists(f'{part_path}.{PARTS_STATE_EXT}'):
+        finalize_download(dst, dst, manifest=manifest, meta=meta)
+        return True
+    return False
+
+
+def is_strong_etag(etag):
+    return bool(etag) and not etag.startswith('W/')
+
+
+def get_resume_headers(part_path, file_size, etag=None):
+    """
+    Returns a tuple (first_byte, headers) of a request for the bytes missing
+    in a .part file, or None if it is already complete (e.g. the download was
+    interrupted before renaming it).  Part files larger than file_size are
+    discarded.
+
+    If etag is a strong ETag, resumed requests are conditional (If-Range),
+    so that the server sends the whole file if it changed.
+
+    """
+    first_byte = os.path.getsize(part_path) if os.path.exists(
+        part_path) else 0
+    if first_byte > file_size:
+        os.remove(part_path)
         first_byte = 0
-    if first_byte >= file_size:
-        return dst, file_size
-    header = {"Range": "bytes=%s-%s" % (first_byte, file_size)}
-    pbar = tqdm(total=file_size,
-                initial=first_byte,
-                unit='B',
-                unit_scale=True,
-                desc=url.split('/')[-1])
-    req = requests.get(url, headers=header, stream=True)
-
-    os.makedirs(os.path.dirname(dst), exist_ok=True)
-    with open(dst, 'ab') as f:
-        for chunk in req.iter_content(chunk_size=1024):
-            if chunk:
-                f.write(chunk)
-                pbar.update(1024)
-    pbar.close()
+    if first_byte == file_size:
+        # Touch empty files, which need no request at all
+        open(part_path, 'ab').close()
+        return None
+    headers = {"Range": f"bytes={first_byte}-{file_size - 1}"}
+    if first_byte and is_strong_etag(etag):
+        headers['If-Range'] = etag
+    return first_byte, headers
+
+
+def check_remote_file(url, status, headers, *, size=None, etag=None):
+    """
+    Raises RemoteFileChangedError if the response (status and headers) of a
+    GET request is not for the version of the file described by size and
+    etag (see get_url_metadata), e.g. because its metadata was cached before
+    the file changed on server.  The size of the file is taken from the total
+    of Content-Range, or from Content-Length if the whole file is sent.
+
+    """
+    res_etag = headers.get('ETag')
+    if etag and res_etag and res_etag != etag:
+        raise RemoteFileChangedError(f"{url} changed on server")
+    if size is None or size < 0:
+        return
+    if status == 206:
+        total = headers.get('Content-Range', '').rpartition('/')[2]
+    elif 'Content-Encoding' not in headers:
+        total = headers.get('Content-Length', '')
+    else:
+        total = ''
+    if total.isdigit() and int(total) != size:
+        raise RemoteFileChangedError(
+            f"{url} changed on server (size {total}, expected {size})")
+
+
+def check_download_size(received, file_size):
+    if received < file_size:
+        raise IncompleteDownloadError(f"Got {received} of {file_size} bytes")
+
+
+def finalize_download(part_path, dst, *, manifest, meta, checksum=False):
+    """
+    Renames a completely downloaded .part file to dst atomically, and
+    records it in the manifest.
+
+    """
+    info = dict(size=os.path.getsize(part_path),
+                etag=meta.get('etag'),
+                last_modified=meta.get('last_modified'))
+    if checksum:
+        info['sha256'] = file_checksum(part_path)
+    os.replace(part_path, dst)
+    manifest.add(dst, **info)
+
+
+def download_stream(url,
+                    dst,
+                    file_size,
+                    *,
+                    session,
+                    chunk_size,
+                    max_retries=DEFAULT_MAX_RETRIES,
+                    remote_size=None,
+                    etag=None,
+                    progress=None,
+                    metrics=None):
+    """
+    Download the first file_size bytes of a URL into dst, in a single
+    stream, resuming from the bytes already written to dst.
+
+    If the response is not for the file of remote_size bytes and etag
+    expected, RemoteFileChangedError is raised (see check_remote_file).
+
+    """
+    def transfer():
+        # Resume from the bytes already written, also on retries
+        resume = get_resume_headers(dst, file_size, etag=etag)
+        if resume is None:
+            return
+        first_byte, header = resume
+        with RequestTimer('GET', url, metrics=metrics) as timer, \
+                session.get(url, headers=header, stream=True) as req:
+            timer.response(req.status_code)
+            req.raise_for_status()
+            check_remote_file(url,
+                              req.status_code,
+                              req.headers,
+                              size=remote_size,
+                              etag=etag)
+            mode = 'ab'
+            if req.status_code != 206:
+                # Server is sending the whole file (Range header ignored)
+                first_byte, mode = 0, 'wb'
+            with open(dst, mode) as f:
+                written = copy_response(
+                    req,
+                    f,
+                    chunk_size,
+                    callback=progress.add_bytes if progress else None,
+                    timer=timer)
+        check_download_size(first_byte + written, file_size)
+
+    request_with_retries(transfer,
+                         f"GET {url}",
+                         max_retries=max_retries,
+                         metrics=metrics)
+
+
+def load_parts_state(state_path, file_size, num_parts, etag=None):
+    """
+    Loads the list of [start, end, done] byte ranges of a multi-part download
+    from its state file, or splits file_size in num_parts new ranges if there
+    is no valid state (or the remote file changed).
+
+    """
+    try:
+        with open(state_path) as f:
+            state = json.load(f)
+        if state['size'] == file_size and state.get('etag') == etag:
+            return state['parts']
+    except (OSError, ValueError, KeyError):
+        pass
+    part_size = -(-file_size // num_parts)
+    return [[start, min(start + part_size, file_size) - 1, 0]
+            for start in range(0, file_size, part_size)]
+
+
+def save_parts_state(state_path, file_size, parts, etag=None):
+    tmp_path = f'{state_path}.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(dict(size=file_size, etag=etag, parts=parts), f)
+    os.replace(tmp_path, state_path)
+
+
+class PartWriter:
+    """File-like object that writes sequentially from an offset of a file"""
+    def __init__(self, fd, offset):
+        self.fd = fd
+        self.offset = offset
+
+    def write(self, data):
+        n = os.pwrite(self.fd, data, self.offset)
+        self.offset += n
+        return n
+
+
+def download_parts(url,
+                   dst,
+                   file_size,
+                   num_parts,
+                   *,
+                   session,
+                   chunk_size,
+                   max_retries=DEFAULT_MAX_RETRIES,
+                   remote_size=None,
+                   etag=None,
+                   progress=None,
+                   metrics=None):
+    """
+    Download the first file_size bytes of a URL into dst, split in num_parts
+    byte ranges that are fetched concurrently.
+
+    Each part is written at its offset of a preallocated (sparse) file.  The
+    progress of each part is kept in a state file next to dst, so that an
+    interrupted download only fetches the missing ranges when resumed.  The
+    state file is removed when all parts are complete.  Each part is retried
+    on transient errors, from its last written byte.  Parts are requested
+    only if the file did not change on server since etag (If-Range), and
+    RemoteFileChangedError is raised otherwise (see check_remote_file).
+
+    """
+    state_path = f'{dst}.{PARTS_STATE_EXT}'
+    parts = load_parts_state(state_path, file_size, num_parts, etag=etag)
+    lock = threading.Lock()
+
+    fd = os.open(dst, os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        if os.fstat(fd).st_size != file_size:
+            os.ftruncate(fd, file_size)
+        save_parts_state(state_path, file_size, parts, etag=etag)
+
+        def fetch_part(part):
+            start, end, done = part
+            if start + done > end:
+                return
+
+            def update(n):
+                with lock:
+                    part[2] += n
+                    save_parts_state(state_path, file_size, parts, etag=etag)
+                if progress:
+                    progress.add_bytes(n)
+
+            header = {"Range": f"bytes={start + done}-{end}"}
+            if is_strong_etag(etag):
+                header['If-Range'] = etag
+            with RequestTimer('GET', url, metrics=metrics) as timer, \
+                    session.get(url, headers=header, stream=True) as req:
+                timer.response(req.status_code)
+                req.raise_for_status()
+                if req.status_code == 200 and 'If-Range' in header:
+                    raise RemoteFileChangedError(f"{url} changed on server")
+                check_remote_file(url,
+                                  req.status_code,
+                                  req.headers,
+                                  size=remote_size,
+                                  etag=etag)
+                if req.status_code != 206:
+                    raise RuntimeError(
+                        f"Server does not support range requests for {url}")
+                copy_response(req,
+                              PartWriter(fd, start + done),
+                              chunk_size,
+                              callback=update,
+                              timer=timer)
+            if start + part[2] <= end:
+                raise IncompleteDownloadError(
+                    f"Got {part[2]} of {end - start + 1} bytes of part")
+
+        def fetch_part_with_retries(part):
+            request_with_retries(partial(fetch_part, part),
+                                 f"GET {url} (bytes {part[0]}-{part[1]})",
+                                 max_retries=max_retries,
+                                 metrics=metrics)
+
+        with ThreadPool(len(parts)) as pool:
+            pool.map(fetch_part_with_retries, parts)
+    finally:
+        os.close(fd)
 
-    return dst, file_size
+    if any(start + done <= end for start, end, done in parts):
+        raise RuntimeError(f"Download of {url} is incomplete")
+    os.remove(state_path)
@@ -0,0 +1,290 @@
+"""
+Spatial index over the cells of a grid vector.
+
+Grid vectors are converted into a compact binary index file, which is
+memory-mapped when loaded.  An index file has the following layout (all
+integers are little-endian):
+
+- header: magic, format version, source files mtime (ns, latest), size
+  (total) and SHA-1 digest, number of cells and length of the metadata
+  block
+- metadata: JSON object with the CRS (as WKT) and schema of the grid
+- records: one fixed-size record per cell, with its bounds and the offset
+  and length of its name, data path, properties and WKB geometry
+- data: a blob with the variable-length fields of all records
+
+Grids bundled with the package ship with their index file (see the grid
+build scripts).  Indexes of any other grid vector, or of bundled grids whose
+shipped index is out of date, are built in the user cache directory, and
+rebuilt automatically when the source grid vector changes.  Installed
+package files are never modified.
+
+"""
+import hashlib
+import json
+import logging
+import mmap
+import os
+import struct
+import tempfile
+from functools import lru_cache
+
+import fiona
+import numpy as np
+import shapely
+from shapely.geometry import mapping, shape
+from shapely.strtree import STRtree
+
+from ideuy.cache import get_cache_path
+from ideuy.vector import DATA_DIR
+
+_logger = logging.getLogger(__name__)
+
+INDEX_EXT = 'idx'
+INDEX_MAGIC = b'IDEUYGRD'
+INDEX_VERSION = 1
+HEADER = struct.Struct('<8sIqq20sIQ')
+HEADER_MTIME = struct.Struct('<q')
+HEADER_MTIME_OFFSET = struct.calcsize('<8sI')
+# Extensions of sidecar files that hold part of the data of a grid vector
+# (e.g. attributes and CRS of a shapefile), besides the main file
+SIDECAR_EXTS = ('.dbf', '.shx', '.prj', '.cpg')
+RECORD_DTYPE = np.dtype([('bounds', '<f8', 4), ('name', '<u8', 2),
+                         ('data_path', '<u8', 2), ('properties', '<u8', 2),
+                         ('wkb', '<u8', 2)])
+
+
+class GridIndex:
+    """
+    Memory-mapped index over the cells of a grid vector.
+
+    Cell bounding boxes are indexed in a STRtree, so that only the cells
+    whose bounding boxes intersect with a geometry are decoded and tested
+    exactly against it.
+
+    """
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        _, _, _, _, _, count, meta_len = HEADER.unpack_from(self._mm)
+        meta = json.loads(self._mm[HEADER.size:HEADER.size + meta_len])
+        self.crs_wkt = meta['crs_wkt']
+        self.schema = meta['schema']
+
+        records_offset = HEADER.size + meta_len
+        self._records = np.frombuffer(self._mm,
+                                      dtype=RECORD_DTYPE,
+                                      count=count,
+                                      offset=records_offset)
+        self._data_offset = records_offset + RECORD_DTYPE.itemsize * count
+
+        self.bounds = self._records['bounds']
+        self.tree = STRtree(shapely.box(*self.bounds.T))
+
+    def __len__(self):
+        return len(self._records)
+
+    @property
+    def cell_size(self):
+        """Typical (median) cell size of the grid, as (width, height)"""
+        minx, miny, maxx, maxy = self.bounds.T
+        return float(np.median(maxx - minx)), float(np.median(maxy - miny))
+
+    def _field(self, i, key):
+        offset, length = self._records[key][i]
+        start = self._data_offset + int(offset)
+        return self._mm[start:start + int(length)]
+
+    def name(self, i):
+        return self._field(i, 'name').decode()
+
+    def data_path(self, i):
+        return self._field(i, 'data_path').decode()
+
+    def geometries(self, idxs):
+        """Decodes geometries of the cells at idxs"""
+        return shapely.from_wkb([self._field(i, 'wkb') for i in idxs])
+
+    def feature(self, i, geometry=None):
+        """Builds a GeoJSON-like feature for cell at i"""
+        if geometry is None:
+            geometry = self.geometries([i])[0]
+        return {
+            'type': 'Feature',
+            'properties': json.loads(self._field(i, 'properties')),
+            'geometry': mapping(geometry)
+        }
+
+    def query(self, geom, distance=0):
+        """
+        Returns indices of cells that intersect with geom, or are within
+        distance of it if distance > 0, in grid order.
+
+        """
+        # Candidates are cells whose bounding box intersects with geom bounds
+        if distance:
+            candidates = self.tree.query(geom,
+                                         predicate='dwithin',
+                                         distance=distance)
+        else:
+            candidates = self.tree.query(geom)
+        candidates = np.sort(candidates)
+        if not len(candidates):
+            return []
+        # Prepare geometry, as it will be tested against many candidates
+        shapely.prepare(geom)
+        geoms = self.geometries(candidates)
+        if distance:
+            hits = shapely.dwithin(geom, geoms, distance)
+        else:
+            hits = shapely.intersects(geom, geoms)
+        return candidates[hits].tolist()
+
+
+def get_source_files(grid_vector):
+    """Returns the paths of a grid vector and its sidecar files, if any"""
+    base = os.path.splitext(grid_vector)[0]
+    sidecars = [
+        path for ext in SIDECAR_EXTS for path in (f'{base}{ext}',
+                                                   f'{base}{ext.upper()}')
+        if os.path.exists(path)
+    ]
+    return [grid_vector] + sorted(set(sidecars))
+
+
+def source_stat(grid_vector):
+    """Returns latest mtime (ns) and total size of grid vector files"""
+    stats = [os.stat(path) for path in get_source_files(grid_vector)]
+    return max(st.st_mtime_ns for st in stats), sum(st.st_size for st in stats)
+
+
+def source_digest(grid_vector):
+    """Returns the SHA-1 digest of all grid vector files"""
+    h = hashlib.sha1()
+    for path in get_source_files(grid_vector):
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                h.update(chunk)
+    return h.digest()
+
+
+def build_grid_index(grid_vector, output):
+    """Builds an index file from a grid vector"""
+    _logger.info(f"Build grid index for {grid_vector} at {output}")
+    mtime_ns, size = source_stat(grid_vector)
+    digest = source_digest(grid_vector)
+
+    records = []
+    data = bytearray()
+
+    def append(value):
+        offset = len(data)
+        data.extend(value)
+        return offset, len(value)
+
+    with fiona.open(grid_vector) as src:
+        meta = json.dumps(dict(crs_wkt=src.crs_wkt,
+                               schema=src.schema)).encode()
+        for feat in src:
+            props = dict(feat['properties'])
+            shp = shape(feat['geometry'])
+            records.append(
+                (shp.bounds, append(str(props.get('Nombre', '')).encode()),
+                 append(str(props.get('data_path', '')).encode()),
+                 append(json.dumps(props).encode()), append(shp.wkb)))
+
+    header = HEADER.pack(INDEX_MAGIC, INDEX_VERSION, mtime_ns, size, digest,
+                         len(records), len(meta))
+
+    # Write to a temporary file first, and then rename, so that readers
+    # never see a partially written index.
+    output_dir = os.path.dirname(os.path.abspath(output))
+    fd, tmp_path = tempfile.mkstemp(dir=output_dir, suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(header)
+            f.write(meta)
+            f.write(np.array(records, dtype=RECORD_DTYPE).tobytes())
+            f.write(data)
+        os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, output)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+    return output
+
+
+def is_index_fresh(index_path, grid_vector, update=True):
+    """
+    Checks whether an index file is valid and up to date with its grid.
+
+    Source mtime and size, of the grid vector and its sidecar files (see
+    get_source_files), are checked first. If they differ (e.g. the package
+    was reinstalled), the source digest is compared instead, and
+    if it matches and update is true, the index header is updated with the
+    new mtime.
+
+    """
+    try:
+        with open(index_path, 'rb') as f:
+            magic, version, mtime_ns, size, digest, _, _ = HEADER.unpack(
+                f.read(HEADER.size))
+    except (OSError, struct.error):
+        return False
+    if magic != INDEX_MAGIC or version != INDEX_VERSION:
+        return False
+
+    src_mtime_ns, src_size = source_stat(grid_vector)
+    if (mtime_ns, size) == (src_mtime_ns, src_size):
+        return True
+    if size != src_size or digest != source_digest(grid_vector):
+        return False
+    if not update:
+        return True
+
+    # Content is the same, update header mtime to avoid hashing next time
+    try:
+        with open(index_path, 'r+b') as f:
+            f.seek(HEADER_MTIME_OFFSET)
+            f.write(HEADER_MTIME.pack(src_mtime_ns))
+    except OSError:
+        pass
+    return True
+
+
+def is_bundled(grid_vector):
+    """Checks whether a grid vector is bundled with the package"""
+    data_dir = os.path.realpath(DATA_DIR)
+    path = os.path.realpath(grid_vector)
+    return os.path.commonpath([data_dir, path]) == data_dir
+
+
+def get_index_path(grid_vector):
+    """Returns the index file path of a grid vector in the cache directory"""
+    grid_vector = os.path.abspath(grid_vector)
+    key = hashlib.sha1(grid_vector.encode()).hexdigest()[:12]
+    basename = os.path.splitext(os.path.basename(grid_vector))[0]
+    return get_cache_path('grid_index', f'{basename}-{key}.{INDEX_EXT}')
+
+
+@lru_cache(maxsize=None)
+def load_grid_index(grid_vector):
+    """
+    Loads a GridIndex for a grid vector file, building it if necessary.
+
+    Indexes are cached by path, so that filtering many AOIs against the same
+    grid only loads the grid index once.
+
+    """
+    # Use the index shipped with bundled grids, but never update it
+    if is_bundled(grid_vector):
+        path = f'{grid_vector}.{INDEX_EXT}'
+        if is_index_fresh(path, grid_vector, update=False):
+            return GridIndex(path)
+
+    path = get_index_path(grid_vector)
+    if is_index_fresh(path, grid_vector):
+        return GridIndex(path)
+    return GridIndex(build_grid_index(grid_vector, path))
@@ -0,0 +1,196 @@
+"""
+Persistent store of download jobs.
+
+Each job is a file of a grid cell for a product type, and is tracked in a
+SQLite database with its status, size in bytes and number of attempts, so
+that an interrupted bulk download can be resumed from pending jobs only,
+without any request for completed files.
+
+A job store can also be shared by many worker processes, possibly on
+different hosts (over a shared filesystem).  Workers claim jobs with a
+lease, which they renew periodically while downloading (heartbeat).  Jobs
+whose lease expired, e.g. because their worker died, can be claimed again
+by other workers.
+
+"""
+import os
+import sqlite3
+import threading
+import time
+from urllib.parse import urlparse
+
+PENDING = 'pending'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+
+# Seconds a claimed job is leased to a worker, unless renewed
+LEASE_DURATION = 5 * 60
+# Max number of attempts of a job, when claimed by workers
+DEFAULT_MAX_ATTEMPTS = 3
+
+COLUMNS = ('id', 'cell', 'product_type', 'file', 'url', 'status', 'size',
+           'attempts', 'error', 'worker', 'lease_expires', 'updated_at')
+
+
+def get_file_name(url):
+    return os.path.basename(urlparse(url).path)
+
+
+class JobStore:
+    """
+    Download jobs stored in a SQLite database.
+
+    Jobs are identified by (cell, product_type, file), where file is the
+    file name in the URL.  Adding jobs that already exist only updates their
+    URL, so a store can be populated again from the same grid on every run.
+
+    """
+    def __init__(self, path, lease_duration=LEASE_DURATION):
+        self.path = path
+        self.lease_duration = lease_duration
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path,
+                                     timeout=60,
+                                     isolation_level=None,
+                                     check_same_thread=False)
+        # WAL mode needs shared memory between processes, so it does not
+        # work on network filesystems.  Use a rollback journal instead.
+        self._conn.execute('PRAGMA journal_mode=DELETE')
+        self._conn.execute('CREATE TABLE IF NOT EXISTS jobs ('
+                           'id INTEGER PRIMARY KEY, '
+                           'cell TEXT NOT NULL, '
+                           'product_type TEXT NOT NULL, '
+                           'file TEXT NOT NULL, '
+                           'url TEXT NOT NULL, '
+                           f"status TEXT NOT NULL DEFAULT '{PENDING}', "
+                           'size INTEGER, '
+                           'attempts INTEGER NOT NULL DEFAULT 0, '
+                           'error TEXT, '
+                           'worker TEXT, '
+                           'lease_expires REAL, '
+                           'updated_at REAL, '
+                           'UNIQUE (cell, product_type, file))')
+        self._conn.execute('CREATE INDEX IF NOT EXISTS jobs_status '
+                           'ON jobs (product_type, status)')
+
+    def add(self, jobs):
+        """Adds jobs, an iterable of (cell, product_type, url) tuples"""
+        with self._lock:
+            self._conn.execute('BEGIN')
+            try:
+                self._conn.executemany(
+                    'INSERT INTO jobs (cell, product_type, file, url) '
+                    'VALUES (?, ?, ?, ?) '
+                    'ON CONFLICT (cell, product_type, file) '
+                    'DO UPDATE SET url = excluded.url',
+                    ((cell, product_type, get_file_name(url), url)
+                     for cell, product_type, url in jobs))
+            except Exception:
+                self._conn.execute('ROLLBACK')
+                raise
+            self._conn.execute('COMMIT')
+
+    def pending(self, product_type):
+        """
+        Returns all jobs of product_type that are not done, as dicts.
+
+        Jobs that were running are included too, as they were interrupted.
+
+        """
+        with self._lock:
+            rows = self._conn.execute(
+                f'SELECT {", ".join(COLUMNS)} FROM jobs '
+                'WHERE product_type = ? AND status != ? ORDER BY id',
+                (product_type, DONE)).fetchall()
+        return [dict(zip(COLUMNS, row)) for row in rows]
+
+    def counts(self, product_type):
+        """Returns number of jobs and bytes by status, for product_type"""
+        with self._lock:
+            rows = self._conn.execute(
+                'SELECT status, COUNT(*), COALESCE(SUM(size), 0) FROM jobs '
+                'WHERE product_type = ? GROUP BY status',
+                (product_type, )).fetchall()
+        return {status: (count, size) for status, count, size in rows}
+
+    def claim(self,
+              product_type,
+              worker,
+              max_attempts=DEFAULT_MAX_ATTEMPTS):
+        """
+        Claims a job of product_type for worker, and returns it as a dict,
+        or None if there are no jobs left to claim.
+
+        Claimable jobs are pending jobs, failed jobs with less than
+        max_attempts attempts, and running jobs whose lease expired.
+
+        """
+        with self._lock:
+            now = time.time()
+            # Lock database for writing before reading, so that no other
+            # worker can claim the same job.
+            self._conn.execute('BEGIN IMMEDIATE')
+            try:
+                row = self._conn.execute(
+                    f'SELECT {", ".join(COLUMNS)} FROM jobs '
+                    'WHERE product_type = ? AND (status = ? '
+                    'OR (status = ? AND attempts < ?) '
+                    'OR (status = ? AND '
+                    '(lease_expires IS NULL OR lease_expires < ?))) '
+                    'ORDER BY id LIMIT 1',
+                    (product_type, PENDING, FAILED, max_attempts, RUNNING,
+                     now)).fetchone()
+                if row is not None:
+                    self._conn.execute(
+                        'UPDATE jobs SET status = ?, worker = ?, '
+                        'lease_expires = ?, updated_at = ? WHERE id = ?',
+                        (RUNNING, worker, now + self.lease_duration, now,
+                         row[0]))
+            except Exception:
+                self._conn.execute('ROLLBACK')
+                raise
+            self._conn.execute('COMMIT')
+        return dict(zip(COLUMNS, row)) if row is not None else None
+
+    def renew(self, worker):
+        """Renews leases of all running jobs claimed by worker"""
+        with self._lock:
+            self._conn.execute(
+                'UPDATE jobs SET lease_expires = ? '
+                'WHERE worker = ? AND status = ?',
+                (time.time() + self.lease_duration, worker, RUNNING))
+
+    def num_leased(self, product_type):
+        """Returns number of running jobs of product_type with a lease"""
+        with self._lock:
+            count, = self._conn.execute(
+                'SELECT COUNT(*) FROM jobs WHERE product_type = ? AND '
+                'status = ? AND lease_expires >= ?',
+                (product_type, RUNNING, time.time())).fetchone()
+        return count
+
+    def start(self, job_id):
+        self._update(job_id,
+                     'status = ?, attempts = attempts + 1, error = NULL',
+                     RUNNING)
+
+    def finish(self, job_id, size):
+        self._update(
+            job_id, 'status = ?, size = ?, worker = NULL, '
+            'lease_expires = NULL', DONE, size)
+
+    def fail(self, job_id, error):
+        self._update(
+            job_id, 'status = ?, error = ?, worker = NULL, '
+            'lease_expires = NULL', FAILED, error)
+
+    def _update(self, job_id, assignments, *values):
+        with self._lock:
+            self._conn.execute(
+                f'UPDATE jobs SET {assignments}, updated_at = ? '
+                'WHERE id = ?', (*values, time.time(), job_id))
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
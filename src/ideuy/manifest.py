@@ -0,0 +1,107 @@
+"""
+Manifest of completed downloads in an output directory.
+
+The manifest is an append-only JSON lines file, stored in the output
+directory, with one record per completed file: its path relative to the
+output directory, size, ETag, Last-Modified and, optionally, SHA-256
+checksum.  When a file is downloaded again, the latest record wins.
+
+"""
+import hashlib
+import json
+import os
+import threading
+import time
+
+MANIFEST_NAME = '.ideuy_manifest.jsonl'
+
+_manifests = {}
+_manifests_lock = threading.Lock()
+
+
+class Manifest:
+    def __init__(self, output_dir):
+        self.output_dir = output_dir
+        self.path = os.path.join(output_dir, MANIFEST_NAME)
+        self._lock = threading.Lock()
+        self._entries = {}
+        self._load()
+
+    def _load(self):
+        try:
+            with open(self.path) as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # Ignore partially written lines
+                        continue
+                    self._entries[entry['path']] = entry
+        except FileNotFoundError:
+            pass
+
+    def _key(self, path):
+        return os.path.relpath(path, self.output_dir)
+
+    def get(self, path):
+        """Returns manifest record of file at path, or None"""
+        with self._lock:
+            return self._entries.get(self._key(path))
+
+    def add(self, path, **info):
+        """Records file at path as completed"""
+        entry = dict(path=self._key(path), completed_at=time.time(), **info)
+        line = json.dumps(entry) + '\n'
+        with self._lock:
+            os.makedirs(self.output_dir, exist_ok=True)
+            with open(self.path, 'a') as f:
+                f.write(line)
+            self._entries[entry['path']] = entry
+        return entry
+
+    def is_complete(self, path, size=None, verify=False, checksum=False):
+        """
+        Checks whether file at path was completed, with the given size if
+        not None.  If verify is true, also check the size of the file on
+        disk against the manifest.  If checksum is true, also check its
+        SHA-256 checksum, if recorded.
+
+        """
+        entry = self.get(path)
+        if entry is None:
+            return False
+        if size is not None and entry['size'] != size:
+            return False
+        if verify:
+            try:
+                if os.path.getsize(path) != entry['size']:
+                    return False
+            except OSError:
+                return False
+        if checksum and entry.get('sha256'):
+            return file_checksum(path) == entry['sha256']
+        return True
+
+    def is_stale(self):
+        """Checks whether manifest file was removed after being loaded"""
+        with self._lock:
+            return bool(self._entries) and not os.path.exists(self.path)
+
+
+def get_manifest(output_dir):
+    """Returns the manifest of output_dir, shared by all threads"""
+    output_dir = os.path.abspath(output_dir)
+    with _manifests_lock:
+        # Load manifest again if it was removed (e.g. with the output dir)
+        if output_dir not in _manifests or _manifests[output_dir].is_stale():
+            _manifests[output_dir] = Manifest(output_dir)
+        return _manifests[output_dir]
+
+
+def file_checksum(path):
+    """Returns the SHA-256 hex digest of a file"""
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            h.update(chunk)
+    return h.hexdigest()
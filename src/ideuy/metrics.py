@@ -0,0 +1,304 @@
+"""
+Metrics of download requests.
+
+Each request is timed by phase with a RequestTimer, and recorded as a dict
+with method, url, status, bytes, error, and seconds spent on each phase:
+
+* connect: DNS resolution and TCP connection (None on reused connections)
+* tls: TLS handshake (None on reused or plain HTTP connections)
+* ttfb: from sending the request until response headers are received,
+  excluding connection setup
+* transfer: reading the response body from the network
+* write: writing the response body to disk
+* total: whole request, including all phases
+
+Records are aggregated by Metrics, which also calls hooks with each record,
+and can be written as a JSON summary, or as a Prometheus textfile (e.g. for
+the textfile collector of node_exporter).
+
+Download functions (see ideuy.download and ideuy.aio) take an optional
+`metrics`, to record their requests in.  Bulk downloads also take
+`metrics_output`, a path to write metrics to when done (see
+collect_metrics).
+
+"""
+import json
+import os
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+
+from urllib3.connection import HTTPConnection, HTTPSConnection
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+
+PHASES = ('connect', 'tls', 'ttfb', 'transfer', 'write', 'total')
+# Upper bounds (seconds) of histogram buckets of phase timings
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+PROMETHEUS_EXT = 'prom'
+
+# Connection setup times of the current thread, since last request started
+_local = threading.local()
+
+
+def add_connection_time(phase, seconds):
+    times = getattr(_local, 'times', None)
+    if times is None:
+        times = _local.times = {}
+    times[phase] = times.get(phase, 0) + seconds
+
+
+def pop_connection_times():
+    """Returns and resets connection setup times of the current thread"""
+    times = getattr(_local, 'times', None) or {}
+    _local.times = {}
+    return times
+
+
+class TimedHTTPConnection(HTTPConnection):
+    """HTTP connection that records its connection setup time"""
+    def _new_conn(self):
+        start = time.perf_counter()
+        try:
+            return super()._new_conn()
+        finally:
+            add_connection_time('connect', time.perf_counter() - start)
+
+
+class TimedHTTPSConnection(HTTPSConnection):
+    """HTTPS connection that records its connection and TLS setup times"""
+    def _new_conn(self):
+        start = time.perf_counter()
+        try:
+            return super()._new_conn()
+        finally:
+            self._connect_time = time.perf_counter() - start
+            add_connection_time('connect', self._connect_time)
+
+    def connect(self):
+        self._connect_time = 0
+        start = time.perf_counter()
+        try:
+            return super().connect()
+        finally:
+            add_connection_time(
+                'tls',
+                time.perf_counter() - start - self._connect_time)
+
+
+class TimedHTTPConnectionPool(HTTPConnectionPool):
+    ConnectionCls = TimedHTTPConnection
+
+
+class TimedHTTPSConnectionPool(HTTPSConnectionPool):
+    ConnectionCls = TimedHTTPSConnection
+
+
+# Pool classes for urllib3 pool managers, to time connection setup
+POOL_CLASSES_BY_SCHEME = {
+    'http': TimedHTTPConnectionPool,
+    'https': TimedHTTPSConnectionPool,
+}
+
+
+class RequestTimer:
+    """
+    Times the phases of a request, and adds its record to metrics (if set)
+    when done.
+
+    Use as a context manager around a request.  Call `response` when
+    response headers are received, and `add` to add time spent on body
+    phases (or bytes).  Errors raised in the block are recorded too.
+
+    """
+    def __init__(self, method, url, metrics=None):
+        self.metrics = metrics
+        self.record = dict(method=method,
+                           url=url,
+                           status=None,
+                           bytes=0,
+                           error=None,
+                           **{phase: None
+                              for phase in PHASES})
+        self._start = None
+
+    def __enter__(self):
+        pop_connection_times()
+        self._start = time.perf_counter()
+        return self
+
+    def response(self, status):
+        """Records response status, and time until its headers"""
+        elapsed = time.perf_counter() - self._start
+        self.record['status'] = status
+        self._add_connection_times()
+        self.record['ttfb'] = max(
+            elapsed - (self.record['connect'] or 0) -
+            (self.record['tls'] or 0), 0)
+
+    def add(self, key, value):
+        self.record[key] = (self.record[key] or 0) + value
+
+    def _add_connection_times(self):
+        for phase, seconds in pop_connection_times().items():
+            self.add(phase, seconds)
+
+    def __exit__(self, exc_type, exc, tb):
+        self.record['total'] = time.perf_counter() - self._start
+        if self.record['status'] is None:
+            # Connection failed, or request did not get a response
+            self._add_connection_times()
+        if exc is not None:
+            self.record['error'] = repr(exc)
+        if self.metrics is not None:
+            self.metrics.add(self.record)
+
+
+class Metrics:
+    """
+    Aggregated metrics of download requests.
+
+    hooks are functions called with the record of each request (see
+    RequestTimer), from the thread that made the request, so they should be
+    thread-safe and fast.
+
+    """
+    def __init__(self, hooks=()):
+        self.hooks = list(hooks)
+        self.requests = Counter()
+        self.errors = 0
+        self.retries = 0
+        self.bytes = 0
+        self.phases = {
+            phase: dict(count=0,
+                        sum=0,
+                        max=0,
+                        buckets=[0] * (len(BUCKETS) + 1))
+            for phase in PHASES
+        }
+        self._started = time.monotonic()
+        self._lock = threading.Lock()
+
+    def add_hook(self, hook):
+        self.hooks.append(hook)
+
+    def add(self, record):
+        """Adds the record of a request, and calls hooks with it"""
+        with self._lock:
+            self.requests[(record['method'], record['status'])] += 1
+            self.errors += record['error'] is not None
+            self.bytes += record['bytes']
+            for phase in PHASES:
+                seconds = record[phase]
+                if seconds is None:
+                    continue
+                stats = self.phases[phase]
+                stats['count'] += 1
+                stats['sum'] += seconds
+                stats['max'] = max(stats['max'], seconds)
+                bucket = next(
+                    (i for i, le in enumerate(BUCKETS) if seconds <= le),
+                    len(BUCKETS))
+                stats['buckets'][bucket] += 1
+        for hook in self.hooks:
+            hook(record)
+
+    def add_retry(self, err=None):
+        with self._lock:
+            self.retries += 1
+
+    def summary(self):
+        """Returns a dict with a summary of all metrics"""
+        with self._lock:
+            requests = {}
+            for (method, status), count in sorted(self.requests.items(),
+                                                  key=str):
+                by_status = requests.setdefault(method, {})
+                by_status[str(status or 'error')] = count
+            phases = {}
+            for phase, stats in self.phases.items():
+                count = stats['count']
+                phases[phase] = dict(
+                    count=count,
+                    sum=round(stats['sum'], 6),
+                    mean=round(stats['sum'] / count, 6) if count else None,
+                    max=round(stats['max'], 6))
+            return dict(duration=round(time.monotonic() - self._started, 3),
+                        requests=sum(self.requests.values()),
+                        requests_by_status=requests,
+                        errors=self.errors,
+                        retries=self.retries,
+                        bytes=self.bytes,
+                        phases=phases)
+
+    def to_prometheus(self):
+        """Returns all metrics in Prometheus text format"""
+        lines = []
+
+        def metric(name, type_, help_, samples):
+            lines.append(f'# HELP ideuy_download_{name} {help_}')
+            lines.append(f'# TYPE ideuy_download_{name} {type_}')
+            for suffix, labels, value in samples:
+                labels = ','.join(f'{k}="{v}"' for k, v in labels.items())
+                labels = f'{{{labels}}}' if labels else ''
+                lines.append(f'ideuy_download_{name}{suffix}{labels} {value}')
+
+        with self._lock:
+            metric('duration_seconds', 'gauge', 'Duration of the batch',
+                   [('', {}, round(time.monotonic() - self._started, 3))])
+            metric('requests_total', 'counter',
+                   'HTTP requests, by method and status',
+                   [('', dict(method=method, status=status or 'error'),
+                     count)
+                    for (method, status), count in sorted(
+                        self.requests.items(), key=str)])
+            metric('errors_total', 'counter', 'Failed HTTP requests',
+                   [('', {}, self.errors)])
+            metric('retries_total', 'counter', 'Retried HTTP requests',
+                   [('', {}, self.retries)])
+            metric('bytes_total', 'counter', 'Bytes downloaded',
+                   [('', {}, self.bytes)])
+            samples = []
+            for phase, stats in self.phases.items():
+                cumulative = 0
+                for le, count in zip(BUCKETS + ('+Inf', ),
+                                     stats['buckets']):
+                    cumulative += count
+                    samples.append(
+                        ('_bucket', dict(phase=phase, le=le), cumulative))
+                samples.append(('_sum', dict(phase=phase), stats['sum']))
+                samples.append(('_count', dict(phase=phase), stats['count']))
+            metric('phase_seconds', 'histogram',
+                   'Seconds spent on each phase of HTTP requests', samples)
+        return '\n'.join(lines) + '\n'
+
+    def write(self, path):
+        """
+        Writes metrics to path, as a Prometheus textfile if its extension is
+        .prom, otherwise as a JSON summary.  The file is replaced atomically.
+
+        """
+        if path.endswith(f'.{PROMETHEUS_EXT}'):
+            content = self.to_prometheus()
+        else:
+            content = json.dumps(self.summary(), indent=2) + '\n'
+        tmp_path = f'{path}.tmp'
+        with open(tmp_path, 'w') as f:
+            f.write(content)
+        os.replace(tmp_path, path)
+
+
+@contextmanager
+def collect_metrics(metrics=None, output=None):
+    """
+    Yields metrics, or new Metrics if None and output is set, and writes
+    them to output (see Metrics.write) when done, even on errors.
+
+    """
+    if metrics is None and output:
+        metrics = Metrics()
+    try:
+        yield metrics
+    finally:
+        if output:
+            metrics.write(output)
@@ -0,0 +1,177 @@
+"""
+Aggregated progress of bulk downloads.
+
+Download threads only increment counters, without locks: each thread has
+its own slot of counters, that only that thread writes to.  A reporter
+thread sums all slots at a fixed interval, and either renders a single
+progress bar, or emits progress events as JSON lines (NDJSON).
+
+Download functions (see ideuy.download and ideuy.aio) take an optional
+`progress`, to add transferred bytes and finished files to.  Bulk downloads
+create their own, which reports as JSON lines on stdout if `progress_json`
+is true, or as a progress bar otherwise.
+
+"""
+import json
+import sys
+import threading
+import time
+
+from tqdm import tqdm
+
+DEFAULT_INTERVAL = 1
+
+FILES = 0
+BYTES = 1
+
+
+class Progress:
+    """
+    Progress of a batch of downloads (number of files and bytes).
+
+    Use as a context manager, to report progress while the batch runs.
+    If json is true, events are written as JSON lines to stream (stdout by
+    default) instead of rendering a progress bar.  Events have an `event`
+    key ('start', 'progress' or 'end'), and files, bytes, totals (if known),
+    elapsed seconds, rate (bytes per second) and ETA (seconds).
+
+    If track_bytes is false (e.g. when only counting files), the progress
+    bar shows files instead of bytes.
+
+    """
+    def __init__(self,
+                 total_files=None,
+                 total_bytes=None,
+                 desc=None,
+                 json=False,
+                 track_bytes=True,
+                 interval=DEFAULT_INTERVAL,
+                 stream=None):
+        self.total_files = total_files
+        self.total_bytes = total_bytes
+        self.desc = desc
+        self.json = json
+        self.track_bytes = track_bytes
+        self.interval = interval
+        self.stream = stream
+
+        self._local = threading.local()
+        # Slots of live threads, and totals of slots of finished threads
+        self._slots = []
+        self._base = [0, 0]
+        self._slots_lock = threading.Lock()
+
+        self._stop = threading.Event()
+        self._thread = None
+        self._pbar = None
+        self._started = None
+        self._last = None
+
+    def _slot(self):
+        slot = getattr(self._local, 'slot', None)
+        if slot is None:
+            slot = self._local.slot = [0, 0]
+            with self._slots_lock:
+                self._slots.append((threading.current_thread(), slot))
+        return slot
+
+    def add_file(self, n=1):
+        self._slot()[FILES] += n
+
+    def add_bytes(self, n):
+        self._slot()[BYTES] += n
+
+    def totals(self):
+        """Returns a tuple (files, bytes) of the current totals"""
+        with self._slots_lock:
+            # Fold slots of finished threads, which will not change anymore
+            live = []
+            for thread, slot in self._slots:
+                if thread.is_alive():
+                    live.append((thread, slot))
+                else:
+                    self._base[FILES] += slot[FILES]
+                    self._base[BYTES] += slot[BYTES]
+            self._slots = live
+            files, nbytes = self._base
+            for _, slot in live:
+                files += slot[FILES]
+                nbytes += slot[BYTES]
+        return files, nbytes
+
+    def __enter__(self):
+        self._started = time.monotonic()
+        self._last = (self._started, 0)
+        if self.json:
+            self._emit('start')
+        else:
+            if self.track_bytes:
+                self._pbar = tqdm(total=self.total_bytes,
+                                  desc=self.desc,
+                                  unit='B',
+                                  unit_scale=True,
+                                  unit_divisor=1024)
+            else:
+                self._pbar = tqdm(total=self.total_files,
+                                  desc=self.desc,
+                                  unit='file')
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._stop.set()
+        self._thread.join()
+        if self.json:
+            self._emit('end')
+        else:
+            self._render()
+            self._pbar.close()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            if self.json:
+                self._emit('progress')
+            else:
+                self._render()
+
+    def _render(self):
+        files, nbytes = self.totals()
+        if self.track_bytes:
+            self._pbar.n = nbytes
+            total_files = self.total_files or '?'
+            self._pbar.set_postfix_str(f'{files}/{total_files} files',
+                                       refresh=False)
+        else:
+            self._pbar.n = files
+        self._pbar.refresh()
+
+    def _emit(self, event):
+        files, nbytes = self.totals()
+        now = time.monotonic()
+        elapsed = now - self._started
+        # Rate over the last interval (average rate on end), and ETA from
+        # the average rate
+        last_time, last_bytes = self._last
+        if event == 'end':
+            last_time, last_bytes = self._started, 0
+        rate = (nbytes - last_bytes) / (now - last_time) \
+            if now > last_time else 0
+        self._last = (now, nbytes)
+        eta = None
+        if self.total_bytes and nbytes and elapsed:
+            eta = (self.total_bytes - nbytes) / (nbytes / elapsed)
+        line = json.dumps(
+            dict(event=event,
+                 time=time.time(),
+                 desc=self.desc,
+                 files=files,
+                 total_files=self.total_files,
+                 bytes=nbytes,
+                 total_bytes=self.total_bytes,
+                 elapsed=round(elapsed, 3),
+                 rate=round(rate, 1),
+                 eta=round(eta, 1) if eta is not None else None))
+        stream = self.stream or sys.stdout
+        stream.write(line + '\n')
+        stream.flush()
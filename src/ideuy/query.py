@@ -1,17 +1,25 @@
 import json
 import logging
-from fnmatch import fnmatch
+import queue
+import re
+import threading
+from fnmatch import translate
+from functools import partial
 from itertools import zip_longest, islice
+from multiprocessing.pool import ThreadPool
 
-import requests
-from shapely.ops import transform
-
-from ideuy.vector import get_vector_bounds_and_crs, reproject_shape, flip
+from ideuy.cache import Cache, get_cache_path
+from ideuy.download import (DEFAULT_MAX_RETRIES, create_session,
+                            download_all, get_session)
+from ideuy.vector import flip, get_vector_feature_boxes, merge_boxes
 
 HOSTNAME = "https://visualizador.ide.uy"
 SERVICE_PATH = "/geonetwork/srv/eng/q"
 SERVICE_URL = f"{HOSTNAME}{SERVICE_PATH}"
 MAX_PAGE_SIZE = 100
+QUERY_CACHE_TTL = 60 * 60
+QUERY_CACHE_MAX_SIZE = 256 * 1024 * 1024
+AOI_MERGE_DISTANCE = 0.01
 DEFAULT_CRS = 'epsg:4326'
 DEFAULT_PARAMS = {
     "_content_type": "json",
@@ -23,8 +31,37 @@ DEFAULT_PARAMS = {
 
 _logger = logging.getLogger(__name__)
 
+_query_cache = None
+_query_cache_lock = threading.Lock()
+
+# Marks the end of the results of a query, in query_all
+_END = object()
+
+
+def query(query=None,
+          aoi=None,
+          limit=None,
+          categories=[],
+          file_filters=[],
+          num_jobs=1,
+          use_cache=True,
+          aoi_merge_distance=AOI_MERGE_DISTANCE):
+    """
+    Query products from the IDEuy catalog
+
+    If aoi is given, the catalog is queried for the bounding box of each
+    feature in the AOI vector, merging boxes closer than
+    aoi_merge_distance (in degrees) to limit the number of queries.
+    Queries are dispatched concurrently with num_jobs workers, and products
+    are deduplicated by UUID.
+
+    Products are generated lazily, as result pages arrive.  If file_filters
+    are given, only matching files of each product are kept (see
+    filter_products_by_files).
+
+    """
+    from shapely.ops import transform
 
-def query(query=None, aoi=None, limit=None, categories=[], file_filters=[]):
     if not categories:
         categories = []
 
@@ -34,27 +71,93 @@ def query(query=None, aoi=None, limit=None, categories=[], file_filters=[]):
         params['title'] = f'{query}*'
 
     if aoi:
-        # TODO: Query for each feature geometry bounds in AOI file...
-        bounds, crs = get_vector_bounds_and_crs(aoi)
-
-        if crs != DEFAULT_CRS:
-            # If crs is not the default one, reproject
-            bounds = reproject_shape(bounds, crs, DEFAULT_CRS)
+        boxes = get_vector_feature_boxes(aoi, crs=DEFAULT_CRS)
+        boxes = merge_boxes(boxes, distance=aoi_merge_distance)
+        _logger.info(f"Query for {len(boxes)} boxes in AOI")
 
         # Flip (latitude,longitude) because the web service expects it the other way...
-        bounds = transform(flip, bounds)
-        params['geometry'] = bounds.wkt
-
-    gen = query_all_pages(params)
+        all_params = [{
+            **params, 'geometry': transform(flip, b).wkt
+        } for b in boxes]
+        gen = query_all(all_params,
+                        num_jobs=num_jobs,
+                        limit=limit,
+                        use_cache=use_cache)
+    else:
+        gen = query_all_pages(params,
+                              num_jobs=num_jobs,
+                              limit=limit,
+                              use_cache=use_cache)
     if limit:
         gen = islice(gen, limit)
     products = build_products(gen)
+    if file_filters:
+        products = filter_products_by_files(products, file_filters)
 
     return products
 
 
+def get_result_uuid(result):
+    info = result.get('geonet:info')
+    return info.get('uuid') if isinstance(info, dict) else None
+
+
+def query_all(all_params, num_jobs=1, limit=None, use_cache=True):
+    """
+    Generates results for many queries, dispatched concurrently with
+    num_jobs workers, skipping results already generated by a previous
+    query (by UUID).
+
+    At most limit results are fetched per query.  Results of each query are
+    generated as they arrive, in query order.
+
+    """
+    if len(all_params) == 1:
+        results = query_all_pages(all_params[0],
+                                  num_jobs=num_jobs,
+                                  limit=limit,
+                                  use_cache=use_cache)
+        yield from results
+        return
+
+    queues = [queue.Queue() for _ in all_params]
+    stop = threading.Event()
+
+    def worker(i):
+        results = queues[i]
+        try:
+            for result in islice(
+                    query_all_pages(all_params[i],
+                                    limit=limit,
+                                    use_cache=use_cache), limit):
+                # Stop fetching pages when the consumer stopped
+                if stop.is_set():
+                    break
+                results.put(result)
+        except Exception as err:
+            results.put(err)
+        results.put(_END)
+
+    seen = set()
+    with ThreadPool(num_jobs) as pool:
+        pool.map_async(worker, range(len(all_params)))
+        try:
+            for results in queues:
+                for result in iter(results.get, _END):
+                    if isinstance(result, Exception):
+                        raise result
+                    uuid = get_result_uuid(result)
+                    if uuid is not None:
+                        if uuid in seen:
+                            continue
+                        seen.add(uuid)
+                    yield result
+        finally:
+            stop.set()
+
+
 def build_products(raw_products):
-    res = []
+    """Generates products with their list of downloadable files"""
     for result in raw_products:
         files = []
         # Build list of downloadable files in product
@@ -69,24 +172,65 @@ def build_products(raw_products):
             if url.startswith('file://'):
                 url = url.replace("file:///opt/", f"{HOSTNAME}/")
                 files.append(dict(id=link_id, name=name, url=url))
-        res.append(dict(**result, __files=files))
+        yield dict(**result, __files=files)
+
+
+def compile_file_filters(file_filters):
+    """
+    Compiles file filters of the form 'key/pattern' (e.g. 'name/*.tif') into
+    a list of (key, regex) tuples
+
+    """
+    res = []
+    for filt in file_filters:
+        key, pattern = filt.split('/')
+        res.append((key, re.compile(translate(pattern))))
     return res
 
 
 def filter_products_by_files(products, file_filters=[]):
-    res = []
+    """
+    Generates products with only the files that match any of the file
+    filters, skipping products without matching files.
+
+    """
+    compiled_filters = compile_file_filters(file_filters)
     for product in products:
         files = []
         # For each file filter, add filtered files to new files list
-        for filt in file_filters:
-            key, pattern = filt.split('/')
+        for key, regex in compiled_filters:
             files.extend(
-                [f for f in product['__files'] if fnmatch(f[key], pattern)])
+                [f for f in product['__files'] if regex.match(f[key])])
         # Only return product if it has any file, after filtering
         if files:
-            product['__files'] = files
-            res.append(product)
-    return res
+            yield {**product, '__files': files}
+
+
+def get_products_urls(products):
+    """Generates the URLs of all files of products"""
+    for product in products:
+        for f in product['__files']:
+            yield f['url']
+
+
+def download_products(products,
+                      num_jobs=1,
+                      engine='thread',
+                      max_retries=DEFAULT_MAX_RETRIES,
+                      *,
+                      output_dir):
+    """
+    Download all files of products (e.g. as generated by query).
+
+    Products are consumed lazily, so downloads start as soon as the first
+    page of results arrives.
+
+    """
+    download_all(get_products_urls(products),
+                 num_jobs=num_jobs,
+                 engine=engine,
+                 max_retries=max_retries,
+                 output_dir=output_dir)
 
 
 def grouper(iterable, n, fillvalue=None):
@@ -96,24 +240,118 @@ def grouper(iterable, n, fillvalue=None):
     return zip_longest(*args, fillvalue=fillvalue)
 
 
-def query_all_pages(params):
-    """Generates results for all pages"""
-    i = 1
-    while True:
-        page_params = {**params, 'from': i, 'to': (i + MAX_PAGE_SIZE - 1)}
-        _logger.info(f"Query: {page_params}")
-        res = requests.get(SERVICE_URL, params=page_params)
-        if not res.ok:
-            raise RuntimeError(
-                "Status code: {res.status_code}. Response: {res.content}")
+def get_query_cache():
+    """Returns the query results cache, creating it if needed"""
+    global _query_cache
+    with _query_cache_lock:
+        if _query_cache is None:
+            _query_cache = Cache(get_cache_path('query.sqlite'),
+                                 ttl=QUERY_CACHE_TTL,
+                                 max_size=QUERY_CACHE_MAX_SIZE)
+        return _query_cache
+
+
+def query_page(params, item_from, session=None, use_cache=True):
+    """
+    Returns the response body of the results page starting at item_from
+
+    Responses are stored in the query cache, keyed by URL and parameters.
+    Expired responses are revalidated with a conditional request, if the
+    server sent an ETag or Last-Modified header.
+
+    """
+    page_params = {
+        **params, 'from': item_from,
+        'to': (item_from + MAX_PAGE_SIZE - 1)
+    }
+
+    cache = get_query_cache() if use_cache else None
+    key = json.dumps([SERVICE_URL, page_params], sort_keys=True)
+    cached = cache.lookup(key) if cache else None
+    headers = {}
+    if cached:
+        entry, expired = cached
+        if not expired:
+            return json.loads(entry['body'])
+        if entry.get('etag'):
+            headers['If-None-Match'] = entry['etag']
+        if entry.get('last_modified'):
+            headers['If-Modified-Since'] = entry['last_modified']
+
+    if session is None:
+        session = get_session()
+    _logger.info(f"Query: {page_params}")
+    res = session.get(SERVICE_URL, params=page_params, headers=headers)
+    if res.status_code == 304 and cached:
+        cache.touch(key)
+        return json.loads(entry['body'])
+    if not res.ok:
+        raise RuntimeError(
+            f"Status code: {res.status_code}. Response: {res.content}")
+
+    if cache:
+        cache.set(
+            key,
+            dict(body=res.text,
+                 etag=res.headers.get('ETag'),
+                 last_modified=res.headers.get('Last-Modified')))
+    return json.loads(res.content)
+
+
+def get_page_results(body):
+    metadata = body.get('metadata', [])
+    # Make sure metadata is a list (e.g. when there is only 1 result)
+    if not isinstance(metadata, list):
+        metadata = [metadata]
+    return metadata
+
+
+def get_total_count(body):
+    """Returns the total count of results of a query, if available"""
+    try:
+        return int(body['summary']['@count'])
+    except (KeyError, TypeError, ValueError):
+        return None
+
+
+def query_all_pages(params, num_jobs=1, limit=None, use_cache=True):
+    """
+    Generates results for all pages
+
+    If num_jobs > 1, the first page is fetched to learn the total count of
+    results, and the remaining pages are fetched concurrently with num_jobs
+    workers.  Results are generated in order in both cases.
+
+    Pages are served from the query cache if use_cache is true.
 
-        body = json.loads(res.content)
-        metadata = body.get('metadata', [])
+    """
+    body = query_page(params, 1, use_cache=use_cache)
+    metadata = get_page_results(body)
+    for row in metadata:
+        yield row
+    if len(metadata) < MAX_PAGE_SIZE:
+        return
 
-        # Make sure metadata is a list (e.g. when there is only 1 result)
-        if not isinstance(metadata, list):
-            metadata = [metadata]
+    total = get_total_count(body)
+    if num_jobs > 1 and total is not None:
+        if limit:
+            total = min(total, limit)
+        page_starts = range(1 + MAX_PAGE_SIZE, total + 1, MAX_PAGE_SIZE)
+        with create_session(pool_size=num_jobs) as session, \
+                ThreadPool(num_jobs) as pool:
+            worker = partial(query_page,
+                             params,
+                             session=session,
+                             use_cache=use_cache)
+            for body in pool.imap(worker, page_starts):
+                for row in get_page_results(body):
+                    yield row
+        return
 
+    i = 1 + MAX_PAGE_SIZE
+    while not limit or i <= limit:
+        metadata = get_page_results(
+            query_page(params, i, use_cache=use_cache))
         for row in metadata:
             yield row
 
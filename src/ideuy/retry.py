@@ -0,0 +1,120 @@
+"""
+Retry policy and per-host rate limiting for requests to IDE servers.
+
+"""
+import logging
+import random
+import threading
+import time
+from urllib.parse import urlparse
+
+DEFAULT_MAX_RETRIES = 5
+BACKOFF_BASE = 1
+BACKOFF_MAX = 60
+RETRY_STATUS_CODES = frozenset([408, 429, 500, 502, 503, 504])
+
+_logger = logging.getLogger(__name__)
+
+_rate_limiters = {}
+_rate_limiters_lock = threading.Lock()
+
+
+class TokenBucket:
+    """
+    Token bucket rate limiter.
+
+    Tokens are added at `rate` tokens per second, up to `capacity` tokens.
+    Each request takes a token, waiting until one is available.
+
+    """
+    def __init__(self, rate, capacity=1):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self):
+        """Takes a token, and returns seconds to wait until it is available"""
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.capacity, self._tokens +
+                               (now - self._updated) * self.rate)
+            self._updated = now
+            self._tokens -= 1
+            return max(0, -self._tokens / self.rate)
+
+    def acquire(self):
+        """Takes a token, blocking until it is available"""
+        delay = self.reserve()
+        if delay:
+            time.sleep(delay)
+
+
+def get_rate_limiter(url, rate):
+    """
+    Returns the rate limiter for the host of url, shared by all requests to
+    the same host, or None if rate is None.
+
+    """
+    if not rate:
+        return None
+    key = (urlparse(url).netloc, rate)
+    with _rate_limiters_lock:
+        if key not in _rate_limiters:
+            _rate_limiters[key] = TokenBucket(rate)
+        return _rate_limiters[key]
+
+
+def get_backoff_delay(attempt, retry_after=None):
+    """
+    Returns seconds to wait before retry number `attempt` (starting from 0),
+    using exponential backoff with full jitter.  If the server sent a
+    Retry-After delay, wait at least that long.
+
+    """
+    delay = random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * 2**attempt))
+    if retry_after:
+        delay = max(delay, retry_after)
+    return delay
+
+
+def parse_retry_after(value):
+    """Parses a Retry-After header value in seconds (HTTP dates ignored)"""
+    try:
+        return min(float(value), BACKOFF_MAX)
+    except (TypeError, ValueError):
+        return None
+
+
+def call_with_retries(func,
+                      *,
+                      is_retryable,
+                      max_retries=DEFAULT_MAX_RETRIES,
+                      get_retry_after=None,
+                      on_retry=None,
+                      description=None):
+    """
+    Calls func until it succeeds, or raises a non-retryable error, or fails
+    more than max_retries times.
+
+    Errors are retryable if is_retryable(err) is true.  If set, on_retry is
+    called with the error before each retry.
+
+    """
+    attempt = 0
+    while True:
+        try:
+            return func()
+        except Exception as err:
+            if attempt >= max_retries or not is_retryable(err):
+                raise
+            retry_after = get_retry_after(err) if get_retry_after else None
+            delay = get_backoff_delay(attempt, retry_after=retry_after)
+            _logger.warning(f"{description or func} failed ({err!r}). "
+                            f"Retrying in {delay:.1f}s "
+                            f"({attempt + 1}/{max_retries})")
+            if on_retry:
+                on_retry(err)
+            time.sleep(delay)
+            attempt += 1
@@ -1,35 +1,107 @@
-import json
+import csv
 import logging
 import os
-import tempfile
-from functools import partial
+from functools import lru_cache
+from importlib.resources import files
+from multiprocessing import Pool
 
-import fiona
-import pkg_resources
-import pyproj
-from shapely.geometry import box, mapping, shape
-from shapely.ops import transform, unary_union
-
-from ideuy.download import download_grid
+# GIS libraries (fiona, pyproj, shapely) are slow to import, so they are
+# imported only in the functions that need them.
 
 _logger = logging.getLogger(__name__)
 
-DATA_DIR = pkg_resources.resource_filename('ideuy', 'data')
+DATA_DIR = str(files('ideuy') / 'data')
 URBAN_GRID_PATH = os.path.join(DATA_DIR, 'urban_grid.geojson')
 NATIONAL_GRID_PATH = os.path.join(DATA_DIR, 'national_grid.geojson')
 
 GRIDS_BY_TYPE = {'urban': URBAN_GRID_PATH, 'national': NATIONAL_GRID_PATH}
 
+# AOI simplification tolerance, as a fraction of the grid cell size
+SIMPLIFY_TOLERANCE = 0.1
+
+# Number of AOI shapes repaired and merged per job
+UNION_CHUNK_SIZE = 1000
+
+# Extensions of vector files considered AOIs when filtering a directory
+AOI_VECTOR_EXTS = ('.geojson', '.json', '.gpkg', '.shp', '.kml')
+
+
+def get_vector_feature_boxes(vector, crs=None):
+    """
+    Returns the bounding boxes of each feature in a vector file, optionally
+    reprojected to crs.
+
+    """
+    import fiona
+    import pyproj
+    from shapely.geometry import box, shape
 
-def get_vector_bounds_and_crs(vector):
     with fiona.open(vector) as src:
-        return box(*src.bounds), src.crs['init']
+        boxes = [
+            box(*shape(f['geometry']).bounds) for f in src if f['geometry']
+        ]
+        src_crs = src.crs_wkt
+    if crs and pyproj.CRS(src_crs) != pyproj.CRS(crs):
+        boxes = [
+            box(*reproject_shape(b, src_crs, crs).bounds) for b in boxes
+        ]
+    return boxes
+
+
+def merge_boxes(boxes, distance=0):
+    """
+    Merges groups of boxes that are closer than distance to each other into
+    their common bounding box.
+
+    """
+    from shapely.geometry import box
+    from shapely.ops import unary_union
+
+    if not boxes:
+        return []
+    # Buffer boxes by half the distance, so that boxes closer than distance
+    # overlap, and union them to find connected groups.
+    half = distance / 2
+    merged = unary_union([
+        box(*b.bounds).buffer(half, join_style='mitre') if half else b
+        for b in boxes
+    ])
+    parts = getattr(merged, 'geoms', [merged])
+    res = []
+    for part in parts:
+        minx, miny, maxx, maxy = part.bounds
+        res.append(box(minx + half, miny + half, maxx - half, maxy - half))
+    return res
+
+
+@lru_cache(maxsize=32)
+def get_transformer(from_crs, to_crs):
+    """Returns a (cached) transformer between two CRS, in x/y axis order"""
+    import pyproj
+
+    return pyproj.Transformer.from_crs(from_crs, to_crs, always_xy=True)
 
 
 def reproject_shape(shp, from_crs, to_crs):
-    project = partial(pyproj.transform, pyproj.Proj(from_crs),
-                      pyproj.Proj(to_crs))
-    return transform(project, shp)
+    """
+    Reprojects a shape from from_crs to to_crs.
+
+    Coordinates are transformed as whole arrays, instead of point by point.
+
+    """
+    import numpy as np
+    import pyproj
+    import shapely
+
+    transformer = get_transformer(pyproj.CRS.from_user_input(from_crs),
+                                  pyproj.CRS.from_user_input(to_crs))
+
+    def transform_coords(coords):
+        return np.column_stack(transformer.transform(*coords.T))
+
+    return shapely.transform(shp,
+                             transform_coords,
+                             include_z=shapely.has_z(shp))
 
 
 def flip(x, y):
@@ -37,38 +109,272 @@ def flip(x, y):
     return y, x
 
 
-def filter_by_aoi(aoi_vector, *, output, type_id, grid_vector):
+def get_simplify_tolerance(grid, crs_wkt=None):
+    """
+    Returns a tolerance for simplifying AOIs before filtering grid, derived
+    from its cell size, in units of crs_wkt (grid CRS if None).
+
+    """
+    import numpy as np
+    import pyproj
+    from shapely.geometry import box
+
+    width, height = grid.cell_size
+    if crs_wkt and pyproj.CRS(crs_wkt) != pyproj.CRS(grid.crs_wkt):
+        # Reproject a cell at the center of the grid to get its size in
+        # units of the other CRS
+        cx, cy = np.median(grid.bounds[:, :2], axis=0)
+        cell = reproject_shape(box(cx, cy, cx + width, cy + height),
+                               grid.crs_wkt, crs_wkt)
+        minx, miny, maxx, maxy = cell.bounds
+        width, height = maxx - minx, maxy - miny
+    return min(width, height) * SIMPLIFY_TOLERANCE
+
+
+def make_valid_shape(shp):
+    """
+    Repairs an invalid shape.  Parts of polygons that collapse (e.g. spikes
+    or zero-area rings) are kept as lines or points, as they still touch
+    the cells they cross.
+
+    """
+    import shapely
+
+    if shp.is_valid:
+        return shp
+    return shapely.make_valid(shp)
+
+
+def union_shapes(shapes):
+    """Repairs invalid shapes and returns the union of all of them"""
+    from shapely.ops import unary_union
+
+    return unary_union([make_valid_shape(shp) for shp in shapes])
+
+
+def union_shapes_parallel(shapes, num_jobs=1):
+    """
+    Same as union_shapes, but shapes are repaired and merged in chunks in
+    parallel, by num_jobs processes, before the final union.
+
+    """
+    import numpy as np
+    import shapely
+    from shapely.ops import unary_union
+    from shapely.strtree import STRtree
+
+    if num_jobs <= 1 or len(shapes) <= UNION_CHUNK_SIZE:
+        return union_shapes(shapes)
+
+    # Sort shapes from west to east, so that each chunk covers a strip, and
+    # shapes from different chunks seldom overlap.
+    xs = shapely.get_x(shapely.centroid(shapes))
+    shapes = [shapes[i] for i in np.argsort(xs)]
+    chunks = [
+        shapes[i:i + UNION_CHUNK_SIZE]
+        for i in range(0, len(shapes), UNION_CHUNK_SIZE)
+    ]
+    with Pool(num_jobs) as pool:
+        unions = pool.map(union_shapes, chunks)
+
+    # Only parts that intersect with parts from other chunks need to be
+    # merged again.  The rest are already disjoint from all others.
+    parts = shapely.get_parts(unions)
+    chunk_ids = np.repeat(np.arange(len(unions)),
+                          shapely.get_num_geometries(unions))
+    i, j = STRtree(parts).query(parts, predicate='intersects')
+    overlap = np.zeros(len(parts), dtype=bool)
+    overlap[i[chunk_ids[i] != chunk_ids[j]]] = True
+    merged = shapely.get_parts(unary_union(parts[overlap]))
+    parts = np.concatenate([parts[~overlap], merged])
+    # Points or lines (e.g. from collapsed polygons) can not be part of a
+    # multipolygon, so return a collection, as unary_union does.
+    if all(p.geom_type == 'Polygon' for p in parts):
+        return shapely.multipolygons(parts)
+    return shapely.geometrycollections(parts)
+
+
+def read_aoi(aoi_vector, layer=None, num_jobs=1):
+    """
+    Reads all shapes from a layer of the AOI vector, and returns a tuple
+    (aoi_poly, crs_wkt), with the union of all shapes as a single AOI
+    (multi)polygon, or a geometry collection if there are points or lines.
+
+    Invalid AOI shapes are repaired.  Repair and union of AOI shapes is
+    done in parallel by num_jobs processes.
+
+    """
+    import fiona
+    from shapely.geometry import shape
+
+    with fiona.open(aoi_vector, layer=layer) as src:
+        aoi_polys = [shape(f['geometry']) for f in src if f['geometry']]
+        aoi_crs_wkt = src.crs_wkt
+
+    # Repair and union over all AOI shapes to form a single AOI
+    # multipolygon, in case there are many.
+    return union_shapes_parallel(aoi_polys, num_jobs=num_jobs), aoi_crs_wkt
+
+
+def query_grid_by_aoi(grid, aoi_poly, aoi_crs_wkt, simplify=False):
+    """
+    Returns indices of cells from grid (a GridIndex) that intersect with
+    the AOI polygon.
+
+    If simplify is true, AOI is simplified with a tolerance derived from the
+    grid cell size before filtering.  This is much faster for very detailed
+    AOIs, but may select a few more cells along the AOI boundary.
+
+    """
+    import pyproj
+
+    # Simplify and reproject AOI to the grid CRS, if needed.  This is done
+    # once, on the union, instead of on each AOI shape.
+    distance = 0
+    if simplify:
+        tolerance = get_simplify_tolerance(grid, aoi_crs_wkt)
+        _logger.info(f"Simplify AOI with tolerance {tolerance}")
+        # Preserve topology, so that parts smaller than the tolerance do not
+        # collapse into empty geometries.  Simplification moves the AOI
+        # boundary at most by the tolerance, so select cells within that
+        # distance to cover the original AOI.
+        aoi_poly = aoi_poly.simplify(tolerance, preserve_topology=True)
+        distance = get_simplify_tolerance(grid)
+
+    if not aoi_crs_wkt:
+        _logger.warning("AOI vector has no CRS. Assuming it is the same as "
+                        "the grid CRS.")
+    elif pyproj.CRS(aoi_crs_wkt) != pyproj.CRS(grid.crs_wkt):
+        _logger.info("Reproject AOI to grid CRS")
+        aoi_poly = reproject_shape(aoi_poly, aoi_crs_wkt, grid.crs_wkt)
+
+    return grid.query(aoi_poly, distance=distance)
+
+
+def write_grid_cells(grid, idxs, output):
+    """Writes cells from grid at idxs as a GeoJSON vector file"""
+    import fiona
+
+    with fiona.open(output,
+                    'w',
+                    driver='GeoJSON',
+                    crs_wkt=grid.crs_wkt,
+                    schema=grid.schema) as dst:
+        for i, shp in zip(idxs, grid.geometries(idxs)):
+            dst.write(grid.feature(i, geometry=shp))
+
+
+def filter_by_aoi(aoi_vector,
+                  simplify=False,
+                  num_jobs=1,
+                  *,
+                  output,
+                  type_id,
+                  grid_vector):
     """
     Filter a grid vector using polygons from the AOI vector,
     and create a filtered grid GeoJSON as output.
 
+    See query_grid_by_aoi for simplify, and read_aoi for num_jobs.
+
     """
+    from ideuy.grid import load_grid_index
+
     if not grid_vector:
         grid_vector = GRIDS_BY_TYPE[type_id]
 
     # Open aoi_vector, union all polygons into a single AOI polygon
-    with fiona.open(aoi_vector) as src:
-        aoi_polys = [shape(f['geometry']) for f in src]
-        aoi_polys = [shp for shp in aoi_polys if shp.is_valid]
-        aoi_crs = src.crs
-
-    # Union over all AOI shapes to form a single AOI multipolygon,
-    # in case there are many.
-    aoi_poly = unary_union(aoi_polys)
-
-    # For each feature in grid vector, filter those polygons that
-    # intersect with AOI
-    with fiona.open(grid_vector) as src:
-        if aoi_crs != src.crs:
-            raise RuntimeError("AOI vector has different CRS than grid. "
-                               "Please make sure it is EPSG:5381.")
-
-        with fiona.open(output,
-                        'w',
-                        driver='GeoJSON',
-                        crs=src.crs,
-                        schema=src.schema) as dst:
-            for feat in src:
-                shp = shape(feat['geometry'])
-                if shp.intersects(aoi_poly):
-                    dst.write(feat)
+    aoi_poly, aoi_crs_wkt = read_aoi(aoi_vector, num_jobs=num_jobs)
+
+    # Query grid index for cells that intersect with AOI
+    grid = load_grid_index(grid_vector)
+    idxs = query_grid_by_aoi(grid, aoi_poly, aoi_crs_wkt, simplify=simplify)
+    write_grid_cells(grid, idxs, output)
+
+
+def get_aoi_layers(aoi_path):
+    """
+    Lists AOIs in a directory of vector files or in a multi-layer vector
+    file, as tuples (aoi_id, path, layer).
+
+    AOIs from a directory are identified by file name (without extension),
+    and AOIs from a multi-layer file by layer name.  Raises RuntimeError if
+    many files have the same name, as their outputs would overwrite each
+    other.
+
+    """
+    import fiona
+
+    if not os.path.isdir(aoi_path):
+        return [(layer, aoi_path, layer)
+                for layer in fiona.listlayers(aoi_path)]
+
+    aois = [(os.path.splitext(name)[0], os.path.join(aoi_path, name), None)
+            for name in sorted(os.listdir(aoi_path))
+            if name.lower().endswith(AOI_VECTOR_EXTS)]
+    paths_by_id = {}
+    for aoi_id, path, _ in aois:
+        # Output file names may be case insensitive
+        paths_by_id.setdefault(aoi_id.lower(), []).append(path)
+    duplicates = [paths for paths in paths_by_id.values() if len(paths) > 1]
+    if duplicates:
+        raise RuntimeError(f"AOI vectors with the same name: {duplicates}")
+    return aois
+
+
+def filter_by_aois(aoi_path,
+                   simplify=False,
+                   num_jobs=1,
+                   table=False,
+                   *,
+                   output,
+                   type_id,
+                   grid_vector):
+    """
+    Filter a grid vector using many AOIs, from a directory of vector files
+    or a multi-layer vector file (see get_aoi_layers).
+
+    Grid is loaded once, and each AOI is evaluated against it.  If table is
+    false, output is a directory where a filtered grid GeoJSON is created
+    for each AOI, named by AOI id.  Otherwise, output is a CSV file with a
+    row (aoi_id, cell) for each cell that intersects with each AOI.
+
+    See filter_by_aoi for simplify and num_jobs.
+
+    """
+    from ideuy.grid import load_grid_index
+
+    if not grid_vector:
+        grid_vector = GRIDS_BY_TYPE[type_id]
+    grid = load_grid_index(grid_vector)
+
+    aois = get_aoi_layers(aoi_path)
+    if not aois:
+        raise RuntimeError(f"No AOI vectors found in {aoi_path}")
+    _logger.info(f"Filter grid by {len(aois)} AOIs")
+
+    if table:
+        f = open(output, 'w', newline='')
+        writer = csv.writer(f)
+        writer.writerow(['aoi_id', 'cell'])
+    else:
+        os.makedirs(output, exist_ok=True)
+
+    try:
+        for aoi_id, path, layer in aois:
+            _logger.info(f"Filter grid by AOI {aoi_id}")
+            aoi_poly, aoi_crs_wkt = read_aoi(path,
+                                             layer=layer,
+                                             num_jobs=num_jobs)
+            idxs = query_grid_by_aoi(grid,
+                                     aoi_poly,
+                                     aoi_crs_wkt,
+                                     simplify=simplify)
+            if table:
+                writer.writerows((aoi_id, grid.name(i)) for i in idxs)
+            else:
+                write_grid_cells(grid, idxs,
+                                 os.path.join(output, f'{aoi_id}.geojson'))
+    finally:
+        if table:
+            f.close()
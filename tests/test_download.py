@@ -0,0 +1,286 @@
+# -*- coding: utf-8 -*-
+
+import json
+import os
+import re
+import shutil
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+import ideuy.download
+import ideuy.retry
+from ideuy.cache import Cache
+from ideuy.download import (PART_EXT, PARTS_STATE_EXT, download_all,
+                            download_from_url, get_url_metadata,
+                            save_parts_state)
+from ideuy.manifest import MANIFEST_NAME
+
+__author__ = "Damián Silvani"
+__copyright__ = "Damián Silvani"
+__license__ = "mit"
+
+SIZE = 100000
+
+
+class RangeHandler(BaseHTTPRequestHandler):
+    """Serves server.files (path -> bytes), with Range and If-Range"""
+    def log_message(self, *args):
+        pass
+
+    def do_HEAD(self):
+        self.respond(body=False)
+
+    def do_GET(self):
+        self.server.requests.append(self.headers.get('Range'))
+        self.respond(body=True)
+
+    def respond(self, body):
+        data = self.server.files.get(self.path)
+        if data is None:
+            self.send_error(404)
+            return
+        etag = f'"{len(data)}-{hash(data)}"'
+        start, end = 0, len(data) - 1
+        m = re.match(r'bytes=(\d+)-(\d+)', self.headers.get('Range') or '')
+        if_range = self.headers.get('If-Range')
+        if m and (if_range is None or if_range == etag):
+            start, end = int(m.group(1)), int(m.group(2))
+            if start >= len(data):
+                self.send_response(416)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            self.send_response(206)
+            self.send_header('Content-Range',
+                             f'bytes {start}-{end}/{len(data)}')
+        else:
+            self.send_response(200)
+        self.send_header('Content-Length', str(end - start + 1))
+        if self.server.etag:
+            self.send_header('ETag', etag)
+        self.end_headers()
+        if body and self.server.drop_after:
+            # Reset connection partway through the body, once
+            self.wfile.write(data[start:start + self.server.drop_after])
+            self.server.drop_after = None
+            self.close_connection = True
+        elif body:
+            self.wfile.write(data[start:end + 1])
+
+
+@pytest.fixture
+def server():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), RangeHandler)
+    server.files = {'/tile.tif': os.urandom(SIZE)}
+    server.requests = []
+    server.etag = True
+    server.drop_after = None
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    host, port = server.server_address
+    server.url = f'http://{host}:{port}/tile.tif'
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def download(server, output_dir, **kwargs):
+    return download_from_url(server.url,
+                             str(output_dir),
+                             use_cache=False,
+                             max_retries=0,
+                             **kwargs)
+
+
+def read(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+def test_download_skips_files_in_manifest(server, tmp_path):
+    dst, size = download(server, tmp_path)
+    assert size == SIZE
+    assert read(dst) == server.files['/tile.tif']
+    assert os.path.exists(tmp_path / MANIFEST_NAME)
+
+    download(server, tmp_path)
+    assert len(server.requests) == 1
+
+
+def test_download_again_missing_or_corrupt_files(server, tmp_path):
+    dst, _ = download(server, tmp_path, checksum=True)
+
+    os.remove(dst)
+    download(server, tmp_path, checksum=True)
+    assert read(dst) == server.files['/tile.tif']
+
+    with open(dst, 'r+b') as f:
+        f.write(b'corrupt')
+    download(server, tmp_path, checksum=True)
+    assert read(dst) == server.files['/tile.tif']
+    assert len(server.requests) == 3
+
+
+def test_download_again_after_output_dir_is_removed(server, tmp_path):
+    output_dir = tmp_path / 'output'
+    download(server, output_dir)
+    shutil.rmtree(output_dir)
+    dst, _ = download(server, output_dir)
+    assert read(dst) == server.files['/tile.tif']
+    assert os.path.exists(output_dir / MANIFEST_NAME)
+
+
+def test_download_resumes_part_file(server, tmp_path):
+    data = server.files['/tile.tif']
+    with open(tmp_path / f'tile.tif.{PART_EXT}', 'wb') as f:
+        f.write(data[:1000])
+
+    dst, _ = download(server, tmp_path)
+    assert read(dst) == data
+    assert server.requests == [f'bytes=1000-{SIZE - 1}']
+
+
+def test_download_finalizes_complete_part_file(server, tmp_path):
+    # e.g. interrupted after writing the last byte, before renaming
+    data = server.files['/tile.tif']
+    with open(tmp_path / f'tile.tif.{PART_EXT}', 'wb') as f:
+        f.write(data)
+
+    dst, _ = download(server, tmp_path)
+    assert read(dst) == data
+    assert not server.requests
+
+
+def test_download_discards_part_file_larger_than_file(server, tmp_path):
+    data = server.files['/tile.tif']
+    with open(tmp_path / f'tile.tif.{PART_EXT}', 'wb') as f:
+        f.write(data + b'extra')
+
+    dst, _ = download(server, tmp_path)
+    assert read(dst) == data
+    assert server.requests == [f'bytes=0-{SIZE - 1}']
+
+
+def test_download_parts_restarts_if_file_changed(server, tmp_path,
+                                                 monkeypatch):
+    cache = Cache(str(tmp_path / 'metadata.sqlite'))
+    monkeypatch.setattr(ideuy.download, 'get_metadata_cache', lambda: cache)
+    old = os.urandom(3 * 1024 * 1024)
+    server.files['/tile.tif'] = old
+    meta = get_url_metadata(server.url)
+
+    # Interrupted multi-part download of the old version
+    output_dir = tmp_path / 'output'
+    os.makedirs(output_dir)
+    part_path = str(output_dir / f'tile.tif.{PART_EXT}')
+    half = len(old) // 2
+    with open(part_path, 'wb') as f:
+        f.write(old[:1000])
+        f.truncate(len(old))
+    save_parts_state(f'{part_path}.{PARTS_STATE_EXT}',
+                     len(old), [[0, half - 1, 1000], [half, len(old) - 1, 0]],
+                     etag=meta['etag'])
+
+    # File changes on server, while its metadata is still cached
+    new = os.urandom(len(old))
+    server.files['/tile.tif'] = new
+    dst, _ = download_from_url(server.url,
+                               str(output_dir),
+                               num_parts=2,
+                               max_retries=0)
+    assert read(dst) == new
+    assert cache.get(server.url)['etag'] != meta['etag']
+
+
+def test_download_all_asyncio(server, tmp_path, monkeypatch):
+    aio = pytest.importorskip('ideuy.aio')
+    pytest.importorskip('aiohttp')
+    monkeypatch.setattr(aio, 'get_metadata_cache', lambda: None)
+    data = server.files['/tile.tif']
+    with open(tmp_path / f'tile.tif.{PART_EXT}', 'wb') as f:
+        f.write(data[:1000])
+
+    with pytest.raises(RuntimeError):
+        download_all([server.url],
+                     engine='asyncio',
+                     num_parts=2,
+                     output_dir=str(tmp_path))
+
+    download_all([server.url],
+                 engine='asyncio',
+                 max_retries=0,
+                 checksum=True,
+                 output_dir=str(tmp_path))
+    assert read(tmp_path / 'tile.tif') == data
+    assert server.requests == [f'bytes=1000-{SIZE - 1}']
+
+
+@pytest.mark.parametrize('etag', [True, False])
+def test_download_stream_restarts_if_file_changed(server, tmp_path,
+                                                  monkeypatch, etag):
+    server.etag = etag
+    cache = Cache(str(tmp_path / 'metadata.sqlite'))
+    monkeypatch.setattr(ideuy.download, 'get_metadata_cache', lambda: cache)
+    server.files['/tile.tif'] = os.urandom(5000)
+    get_url_metadata(server.url)
+
+    # File changes on server, while its metadata is still cached
+    new = os.urandom(8000)
+    server.files['/tile.tif'] = new
+    output_dir = tmp_path / 'output'
+    dst, size = download_from_url(server.url, str(output_dir), max_retries=0)
+    assert size == len(new)
+    assert read(dst) == new
+    assert cache.get(server.url)['size'] == len(new)
+
+
+def test_download_all_asyncio_restarts_if_file_changed(server, tmp_path,
+                                                       monkeypatch):
+    aio = pytest.importorskip('ideuy.aio')
+    pytest.importorskip('aiohttp')
+    cache = Cache(str(tmp_path / 'metadata.sqlite'))
+    monkeypatch.setattr(aio, 'get_metadata_cache', lambda: cache)
+    server.files['/tile.tif'] = os.urandom(5000)
+    cache.set(server.url, get_url_metadata(server.url, use_cache=False))
+
+    new = os.urandom(8000)
+    server.files['/tile.tif'] = new
+    output_dir = tmp_path / 'output'
+    download_all([server.url],
+                 engine='asyncio',
+                 max_retries=0,
+                 output_dir=str(output_dir))
+    assert read(output_dir / 'tile.tif') == new
+
+
+def test_download_all_asyncio_counts_only_completed_files(
+        server, tmp_path, monkeypatch, capsys):
+    aio = pytest.importorskip('ideuy.aio')
+    pytest.importorskip('aiohttp')
+    monkeypatch.setattr(aio, 'get_metadata_cache', lambda: None)
+    with pytest.raises(Exception):
+        download_all([server.url.replace('tile', 'missing')],
+                     engine='asyncio',
+                     max_retries=0,
+                     progress_json=True,
+                     output_dir=str(tmp_path))
+    end = json.loads(capsys.readouterr().out.splitlines()[-1])
+    assert end['event'] == 'end'
+    assert end['files'] == 0
+
+
+def test_download_resumes_after_connection_reset(server, tmp_path,
+                                                 monkeypatch):
+    monkeypatch.setattr(ideuy.retry, 'BACKOFF_BASE', 0)
+    server.drop_after = 30000
+    dst, _ = download_from_url(server.url,
+                               str(tmp_path),
+                               use_cache=False,
+                               max_retries=1)
+    assert read(dst) == server.files['/tile.tif']
+    # Resumed from the bytes written before the reset
+    assert server.requests == [
+        f'bytes=0-{SIZE - 1}', f'bytes=30000-{SIZE - 1}'
+    ]
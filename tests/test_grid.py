@@ -0,0 +1,154 @@
+# -*- coding: utf-8 -*-
+
+import json
+import os
+
+import fiona
+import pytest
+
+import ideuy.cache
+import ideuy.grid
+from ideuy.grid import (INDEX_EXT, build_grid_index, get_index_path,
+                        is_index_fresh, load_grid_index)
+
+__author__ = "Damián Silvani"
+__copyright__ = "Damián Silvani"
+__license__ = "mit"
+
+
+def write_grid(path, n):
+    features = [{
+        'type': 'Feature',
+        'properties': {
+            'Nombre': f'C{i}',
+            'data_path': f'{i}'
+        },
+        'geometry': {
+            'type':
+            'Polygon',
+            'coordinates': [[[i, 0], [i + 1, 0], [i + 1, 1], [i, 1], [i, 0]]]
+        }
+    } for i in range(n)]
+    with open(path, 'w') as f:
+        json.dump({'type': 'FeatureCollection', 'features': features}, f)
+
+
+def touch(path):
+    st = os.stat(path)
+    os.utime(path, ns=(st.st_atime_ns, st.st_mtime_ns + 10**9))
+
+
+def read(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+@pytest.fixture(autouse=True)
+def cache_dir(tmp_path, monkeypatch):
+    path = tmp_path / 'cache'
+    monkeypatch.setattr(ideuy.cache, 'CACHE_DIR', str(path))
+    load_grid_index.cache_clear()
+    yield path
+    load_grid_index.cache_clear()
+
+
+@pytest.fixture
+def grid(tmp_path):
+    path = str(tmp_path / 'grid.geojson')
+    write_grid(path, 3)
+    return path
+
+
+def test_index_of_user_grid_is_built_in_cache(grid):
+    index = load_grid_index(grid)
+    assert len(index) == 3
+    assert index.path == get_index_path(grid)
+    assert not os.path.exists(f'{grid}.{INDEX_EXT}')
+    assert [index.name(i) for i in index.query(index.geometries([1])[0])
+            ] == ['C0', 'C1', 'C2']
+
+
+def test_index_is_rebuilt_when_grid_changes(grid):
+    path = load_grid_index(grid).path
+    write_grid(grid, 5)
+    assert not is_index_fresh(path, grid)
+    load_grid_index.cache_clear()
+    assert len(load_grid_index(grid)) == 5
+
+
+def test_index_header_is_updated_when_only_mtime_changes(grid, monkeypatch):
+    path = load_grid_index(grid).path
+    touch(grid)
+    content = read(path)
+    assert is_index_fresh(path, grid, update=False)
+    assert read(path) == content
+    assert is_index_fresh(path, grid)
+    assert read(path) != content
+    # Digest is not computed anymore
+    monkeypatch.setattr(ideuy.grid, 'source_digest', None)
+    assert is_index_fresh(path, grid)
+
+
+def test_index_of_bundled_grid_is_never_modified(tmp_path, cache_dir,
+                                                  monkeypatch):
+    data_dir = tmp_path / 'data'
+    os.makedirs(data_dir)
+    monkeypatch.setattr(ideuy.grid, 'DATA_DIR', str(data_dir))
+    grid = str(data_dir / 'grid.geojson')
+    write_grid(grid, 3)
+    bundled = build_grid_index(grid, f'{grid}.{INDEX_EXT}')
+    content = read(bundled)
+
+    # Reinstalled package, with the same grid
+    touch(grid)
+    assert load_grid_index(grid).path == bundled
+    assert read(bundled) == content
+    assert not os.path.exists(cache_dir)
+
+    # Changed grid, with an out of date shipped index
+    load_grid_index.cache_clear()
+    write_grid(grid, 4)
+    index = load_grid_index(grid)
+    assert len(index) == 4
+    assert index.path == get_index_path(grid)
+    assert read(bundled) == content
+
+
+def write_shapefile(path, data_paths):
+    schema = {
+        'geometry': 'Polygon',
+        'properties': {
+            'Nombre': 'str',
+            'data_path': 'str'
+        }
+    }
+    with fiona.open(path, 'w', driver='ESRI Shapefile',
+                    schema=schema) as dst:
+        for i, data_path in enumerate(data_paths):
+            dst.write({
+                'geometry': {
+                    'type':
+                    'Polygon',
+                    'coordinates': [[(i, 0), (i + 1, 0), (i + 1, 1), (i, 1),
+                                     (i, 0)]]
+                },
+                'properties': {
+                    'Nombre': f'C{i}',
+                    'data_path': data_path
+                }
+            })
+
+
+def test_index_is_rebuilt_when_shapefile_attributes_change(tmp_path):
+    grid = str(tmp_path / 'grid.shp')
+    write_shapefile(grid, ['a', 'b'])
+    assert load_grid_index(grid).data_path(1) == 'b'
+
+    # Only the .dbf file changes
+    with open(grid, 'rb') as f:
+        shp = f.read()
+    write_shapefile(grid, ['a', 'c'])
+    with open(grid, 'rb') as f:
+        assert f.read() == shp
+    load_grid_index.cache_clear()
+    assert load_grid_index(grid).data_path(1) == 'c'
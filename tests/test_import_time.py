@@ -0,0 +1,52 @@
+# -*- coding: utf-8 -*-
+
+import subprocess
+import sys
+
+import pytest
+
+__author__ = "Damián Silvani"
+__copyright__ = "Damián Silvani"
+__license__ = "mit"
+
+GIS_MODULES = ['fiona', 'pyproj', 'shapely', 'numpy']
+HEAVY_MODULES = GIS_MODULES + ['requests', 'tqdm', 'pkg_resources']
+
+
+def import_times(module):
+    """
+    Imports module in a new interpreter with `-X importtime`, and returns a
+    dict of all imported modules with their cumulative import time (us).
+
+    """
+    res = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+        capture_output=True,
+        text=True,
+        check=True)
+    times = {}
+    for line in res.stderr.splitlines():
+        if not line.startswith('import time:'):
+            continue
+        _, cumulative, name = line.split('|')
+        if cumulative.strip().isdigit():
+            times[name.strip()] = int(cumulative)
+    return times
+
+
+@pytest.mark.parametrize('module',
+                         ['ideuy.console.download', 'ideuy.console.filter'])
+def test_console_scripts_do_not_import_heavy_modules(module):
+    times = import_times(module)
+    imported = [m for m in HEAVY_MODULES if m in times]
+    assert not imported, \
+        f"{module} imports {imported} ({times[module] / 1000:.0f} ms)"
+
+
+@pytest.mark.parametrize('module',
+                         ['ideuy.vector', 'ideuy.download', 'ideuy.query'])
+def test_modules_do_not_import_gis_modules(module):
+    times = import_times(module)
+    imported = [m for m in GIS_MODULES if m in times]
+    assert not imported, \
+        f"{module} imports {imported} ({times[module] / 1000:.0f} ms)"
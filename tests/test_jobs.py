@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -*-
+
+import time
+from multiprocessing.pool import ThreadPool
+
+from ideuy.download import WORKER_POLL_INTERVAL, run_jobs_worker
+from ideuy.jobs import DONE, FAILED, PENDING, RUNNING, JobStore
+
+__author__ = "Damián Silvani"
+__copyright__ = "Damián Silvani"
+__license__ = "mit"
+
+URL = 'https://example.com/{cell}/{name}'
+
+
+def make_store(tmp_path, n=2, **kwargs):
+    store = JobStore(str(tmp_path / 'jobs.sqlite'), **kwargs)
+    store.add((str(cell), 'rgb', URL.format(cell=cell, name=f'{cell}.tif'))
+              for cell in range(n))
+    return store
+
+
+def test_add_is_idempotent(tmp_path):
+    store = make_store(tmp_path)
+    store.add([('0', 'rgb', 'https://mirror.example.com/0/0.tif')])
+    jobs = store.pending('rgb')
+    assert [job['file'] for job in jobs] == ['0.tif', '1.tif']
+    assert jobs[0]['url'] == 'https://mirror.example.com/0/0.tif'
+    assert store.counts('rgb') == {PENDING: (2, 0)}
+
+
+def test_claim_leases_each_job_once(tmp_path):
+    store = make_store(tmp_path)
+    a = store.claim('rgb', 'a')
+    b = store.claim('rgb', 'b')
+    assert (a['cell'], b['cell']) == ('0', '1')
+    assert store.claim('rgb', 'c') is None
+    assert store.claim('dem', 'a') is None
+    assert store.num_leased('rgb') == 2
+
+
+def test_finish_and_fail(tmp_path):
+    store = make_store(tmp_path)
+    a = store.claim('rgb', 'a')
+    b = store.claim('rgb', 'a')
+    store.start(a['id'])
+    store.finish(a['id'], 100)
+    store.start(b['id'])
+    store.fail(b['id'], 'boom')
+    assert store.counts('rgb') == {DONE: (1, 100), FAILED: (1, 0)}
+    assert store.num_leased('rgb') == 0
+    pending, = store.pending('rgb')
+    assert pending['status'] == FAILED
+    assert pending['error'] == 'boom'
+    assert pending['attempts'] == 1
+    assert pending['worker'] is None
+
+
+def test_failed_jobs_are_claimed_up_to_max_attempts(tmp_path):
+    store = make_store(tmp_path, n=1)
+    for _ in range(2):
+        job = store.claim('rgb', 'a', max_attempts=2)
+        store.start(job['id'])
+        store.fail(job['id'], 'boom')
+    assert store.claim('rgb', 'a', max_attempts=2) is None
+    assert store.claim('rgb', 'a', max_attempts=3)['attempts'] == 2
+
+
+def test_expired_leases_are_claimed_again(tmp_path):
+    store = make_store(tmp_path, n=1, lease_duration=0.2)
+    job = store.claim('rgb', 'a')
+    assert store.claim('rgb', 'b') is None
+    time.sleep(0.3)
+    assert store.num_leased('rgb') == 0
+    job = store.claim('rgb', 'b')
+    assert job['status'] == RUNNING
+    assert store.num_leased('rgb') == 1
+
+
+def test_renew_extends_leases_of_worker(tmp_path):
+    store = make_store(tmp_path, lease_duration=0.5)
+    store.claim('rgb', 'a')
+    store.claim('rgb', 'b')
+    time.sleep(0.3)
+    store.renew('a')
+    time.sleep(0.3)
+    # Only the lease of worker b expired
+    assert store.num_leased('rgb') == 1
+    job = store.claim('rgb', 'c')
+    assert job['cell'] == '1'
+    assert store.claim('rgb', 'd') is None
+
+
+def test_worker_threads_exit_when_jobs_finish(tmp_path):
+    store = make_store(tmp_path, n=1)
+    done = []
+
+    def func(job):
+        time.sleep(0.2)
+        store.finish(job['id'], 1)
+        done.append(job['cell'])
+
+    start = time.monotonic()
+    with ThreadPool(4) as pool:
+        run_jobs_worker(store, func, pool, 4, product_type_id='rgb')
+    assert done == ['0']
+    # Idle threads are woken up, instead of polling the store
+    assert time.monotonic() - start < WORKER_POLL_INTERVAL / 2
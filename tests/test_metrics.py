@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+
+import json
+
+import pytest
+
+from ideuy.metrics import Metrics, RequestTimer
+
+__author__ = "Damián Silvani"
+__copyright__ = "Damián Silvani"
+__license__ = "mit"
+
+
+def test_request_timer_records_request_in_metrics():
+    records = []
+    metrics = Metrics(hooks=[records.append])
+    with RequestTimer('GET', 'http://example.com/a', metrics=metrics) as t:
+        t.response(200)
+        t.add('transfer', 0.5)
+        t.add('bytes', 100)
+    with pytest.raises(RuntimeError):
+        with RequestTimer('HEAD', 'http://example.com/b', metrics=metrics):
+            raise RuntimeError("failed")
+    metrics.add_retry()
+
+    assert [r['status'] for r in records] == [200, None]
+    assert records[0]['transfer'] == 0.5
+    assert records[0]['write'] is None
+    assert records[1]['error'] == "RuntimeError('failed')"
+
+    summary = metrics.summary()
+    assert summary['requests'] == 2
+    assert summary['requests_by_status'] == {
+        'GET': {
+            '200': 1
+        },
+        'HEAD': {
+            'error': 1
+        }
+    }
+    assert summary['errors'] == 1
+    assert summary['retries'] == 1
+    assert summary['bytes'] == 100
+    assert summary['phases']['transfer']['count'] == 1
+    assert summary['phases']['total']['count'] == 2
+
+
+def test_metrics_write(tmp_path):
+    metrics = Metrics()
+    with RequestTimer('GET', 'http://example.com/a', metrics=metrics) as t:
+        t.response(206)
+        t.add('transfer', 2)
+
+    metrics.write(str(tmp_path / 'metrics.json'))
+    with open(tmp_path / 'metrics.json') as f:
+        assert json.load(f)['requests'] == 1
+
+    metrics.write(str(tmp_path / 'metrics.prom'))
+    lines = (tmp_path / 'metrics.prom').read_text().splitlines()
+    assert 'ideuy_download_requests_total{method="GET",status="206"} 1' \
+        in lines
+    assert 'ideuy_download_phase_seconds_bucket{phase="transfer",le="1"} 0' \
+        in lines
+    assert 'ideuy_download_phase_seconds_bucket{phase="transfer",le="2.5"} 1' \
+        in lines
+    assert 'ideuy_download_phase_seconds_count{phase="transfer"} 1' in lines
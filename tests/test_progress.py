@@ -0,0 +1,39 @@
+# -*- coding: utf-8 -*-
+
+import io
+import json
+import threading
+
+from ideuy.progress import Progress
+
+__author__ = "Damián Silvani"
+__copyright__ = "Damián Silvani"
+__license__ = "mit"
+
+
+def test_progress_sums_counters_of_all_threads():
+    stream = io.StringIO()
+    with Progress(total_files=8,
+                  total_bytes=8000,
+                  json=True,
+                  interval=0.01,
+                  stream=stream) as progress:
+
+        def download():
+            for _ in range(10):
+                progress.add_bytes(100)
+            progress.add_file()
+
+        threads = [threading.Thread(target=download) for _ in range(8)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        assert progress.totals() == (8, 8000)
+
+    events = [json.loads(line) for line in stream.getvalue().splitlines()]
+    assert events[0]['event'] == 'start'
+    assert events[-1]['event'] == 'end'
+    assert events[-1]['files'] == 8
+    assert events[-1]['bytes'] == 8000
+    assert events[-1]['total_bytes'] == 8000
@@ -0,0 +1,202 @@
+# -*- coding: utf-8 -*-
+
+import json
+import time
+
+import pytest
+
+import ideuy.query
+from ideuy.cache import Cache
+from ideuy.query import (HOSTNAME, MAX_PAGE_SIZE, build_products,
+                         compile_file_filters, filter_products_by_files,
+                         get_products_urls, query_all, query_all_pages,
+                         query_page)
+
+__author__ = "Damián Silvani"
+__copyright__ = "Damián Silvani"
+__license__ = "mit"
+
+
+class Catalog:
+    """Fake catalog with total results per query (by 'q' param)"""
+    def __init__(self, totals, count=True):
+        self.totals = totals
+        self.count = count
+        self.requests = []
+
+    def query_page(self, params, item_from, session=None, use_cache=True):
+        self.requests.append((params['q'], item_from))
+        total = self.totals[params['q']]
+        end = min(item_from + MAX_PAGE_SIZE - 1, total)
+        return {
+            'summary': {
+                '@count': str(total) if self.count else None
+            },
+            'metadata': [{
+                'geonet:info': {
+                    'uuid': f"{params['q']}-{i}"
+                }
+            } for i in range(item_from, end + 1)]
+        }
+
+
+@pytest.fixture
+def catalog(monkeypatch):
+    catalog = Catalog({'a': 1000, 'b': 1000})
+    monkeypatch.setattr(ideuy.query, 'query_page', catalog.query_page)
+    return catalog
+
+
+def uuids(results):
+    return [r['geonet:info']['uuid'] for r in results]
+
+
+def test_query_all_limits_results_per_query(catalog):
+    results = list(query_all([{'q': 'a'}, {'q': 'b'}], num_jobs=2, limit=10))
+    assert uuids(results) == [f'a-{i}' for i in range(1, 11)] + \
+        [f'b-{i}' for i in range(1, 11)]
+    assert sorted(catalog.requests) == [('a', 1), ('b', 1)]
+
+
+
+@pytest.mark.parametrize('num_jobs,count', [(1, True), (3, True),
+                                            (3, False)])
+def test_query_all_pages_in_order(catalog, num_jobs, count):
+    catalog.totals['a'] = 450
+    catalog.count = count
+    results = list(query_all_pages({'q': 'a'}, num_jobs=num_jobs))
+    assert uuids(results) == [f'a-{i}' for i in range(1, 451)]
+    assert sorted(catalog.requests) == [('a', i)
+                                        for i in (1, 101, 201, 301, 401)]
+
+
+@pytest.mark.parametrize('num_jobs', [1, 3])
+def test_query_all_pages_fetches_pages_up_to_limit(catalog, num_jobs):
+    results = query_all_pages({'q': 'a'}, num_jobs=num_jobs, limit=150)
+    assert len(list(results)) >= 150
+    assert sorted(catalog.requests) == [('a', 1), ('a', 101)]
+
+
+class Response:
+    def __init__(self, status_code, body=None, headers=None):
+        self.status_code = status_code
+        self.ok = status_code < 400
+        self.text = json.dumps(body) if body is not None else ''
+        self.content = self.text.encode()
+        self.headers = headers or {}
+
+
+class Session:
+    """Fake session that serves a body, with an ETag"""
+    def __init__(self, body, etag='"1"'):
+        self.body = body
+        self.etag = etag
+        self.requests = []
+
+    def get(self, url, params=None, headers=None):
+        self.requests.append(headers)
+        if self.etag and headers.get('If-None-Match') == self.etag:
+            return Response(304)
+        return Response(200, self.body, {'ETag': self.etag})
+
+
+@pytest.fixture
+def cache(tmp_path, monkeypatch):
+    cache = Cache(str(tmp_path / 'query.sqlite'), ttl=60)
+    monkeypatch.setattr(ideuy.query, 'get_query_cache', lambda: cache)
+    return cache
+
+
+def test_query_page_is_cached(cache):
+    session = Session({'metadata': [1]})
+    assert query_page({'q': 'a'}, 1, session=session) == {'metadata': [1]}
+    assert query_page({'q': 'a'}, 1, session=session) == {'metadata': [1]}
+    assert len(session.requests) == 1
+    # Other pages and parameters are cached separately
+    query_page({'q': 'a'}, 101, session=session)
+    query_page({'q': 'b'}, 1, session=session)
+    assert len(session.requests) == 3
+    # Unless use_cache is false
+    query_page({'q': 'a'}, 1, session=session, use_cache=False)
+    assert len(session.requests) == 4
+
+
+@pytest.mark.parametrize('etag', ['"1"', None])
+def test_query_page_revalidates_expired_entries(cache, etag):
+    cache.ttl = 0.1
+    session = Session({'metadata': [1]}, etag=etag)
+    query_page({'q': 'a'}, 1, session=session)
+    time.sleep(0.2)
+    session.body = {'metadata': [2]}
+    body = query_page({'q': 'a'}, 1, session=session)
+    if etag:
+        # Not modified, so the cached body is renewed
+        assert session.requests[-1] == {'If-None-Match': etag}
+        assert body == {'metadata': [1]}
+        query_page({'q': 'a'}, 1, session=session)
+        assert len(session.requests) == 2
+    else:
+        assert session.requests[-1] == {}
+        assert body == {'metadata': [2]}
+
+
+def test_cache_evicts_oldest_entries(tmp_path):
+    cache = Cache(str(tmp_path / 'cache.sqlite'), max_size=25)
+    for key in 'abc':
+        cache.set(key, 'x' * 10)
+        time.sleep(0.01)
+    assert cache.get('a') is None
+    assert cache.get('b') == cache.get('c') == 'x' * 10
+
+
+def test_query_all_skips_duplicate_products(catalog):
+    # Products of b overlap with products of a (e.g. in adjacent boxes)
+    catalog.totals = {'a': 3, 'b': 3}
+    results = query_all([{'q': 'a'}, {'q': 'a'}, {'q': 'b'}], num_jobs=2)
+    assert uuids(results) == ['a-1', 'a-2', 'a-3', 'b-1', 'b-2', 'b-3']
+
+
+def make_product(*names):
+    return {
+        'link': [
+            f'{i}|{name}|file:///opt/data/{name}|application/octet-stream'
+            for i, name in enumerate(names)
+        ]
+    }
+
+
+def test_build_products():
+    product, = build_products([make_product('a.tif')])
+    assert product['__files'] == [
+        dict(id='0', name='a.tif', url=f'{HOSTNAME}/data/a.tif')
+    ]
+
+
+def test_compile_file_filters():
+    (key, regex), = compile_file_filters(['name/*.tif'])
+    assert key == 'name'
+    assert regex.match('a.tif')
+    assert not regex.match('a.tif.aux.xml')
+
+
+def test_filter_products_by_files():
+    raw = [make_product('a.tif', 'a.jgw'), make_product('b.jgw')]
+    products = list(
+        filter_products_by_files(build_products(raw),
+                                 ['name/*.tif', 'name/*.jgw']))
+    assert list(get_products_urls(products)) == [
+        f'{HOSTNAME}/data/{name}' for name in ('a.tif', 'a.jgw', 'b.jgw')
+    ]
+    products = filter_products_by_files(build_products(raw), ['name/*.tif'])
+    assert [[f['name'] for f in p['__files']]
+            for p in products] == [['a.tif']]
+
+
+def test_products_are_generated_lazily():
+    def raw():
+        yield make_product('a.tif')
+        raise AssertionError("Consumed too early")
+
+    products = filter_products_by_files(build_products(raw()),
+                                        ['name/*.tif'])
+    assert next(get_products_urls(products)) == f'{HOSTNAME}/data/a.tif'
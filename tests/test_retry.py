@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+
+import time
+
+import pytest
+
+import ideuy.retry
+from ideuy.retry import (BACKOFF_MAX, TokenBucket, call_with_retries,
+                         get_backoff_delay, get_rate_limiter,
+                         parse_retry_after)
+
+__author__ = "Damián Silvani"
+__copyright__ = "Damián Silvani"
+__license__ = "mit"
+
+
+class FakeTime:
+    """Replaces the time module in ideuy.retry, recording sleeps"""
+    def __init__(self):
+        self.sleeps = []
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+
+    monotonic = staticmethod(time.monotonic)
+
+
+@pytest.fixture
+def fake_time(monkeypatch):
+    fake = FakeTime()
+    monkeypatch.setattr(ideuy.retry, 'time', fake)
+    return fake
+
+
+class TransientError(Exception):
+    def __init__(self, retry_after=None):
+        self.retry_after = retry_after
+
+
+def failing(errors, result='ok'):
+    """Returns a function that raises errors in order, and then succeeds"""
+    errors = list(errors)
+    calls = []
+
+    def func():
+        calls.append(1)
+        if errors:
+            raise errors.pop(0)
+        return result
+
+    func.calls = calls
+    return func
+
+
+def call(func, **kwargs):
+    return call_with_retries(
+        func,
+        is_retryable=lambda err: isinstance(err, TransientError),
+        get_retry_after=lambda err: err.retry_after,
+        **kwargs)
+
+
+def test_token_bucket():
+    bucket = TokenBucket(10)
+    assert bucket.reserve() == 0
+    assert bucket.reserve() == pytest.approx(0.1, abs=0.01)
+    assert bucket.reserve() == pytest.approx(0.2, abs=0.01)
+
+
+def test_token_bucket_refills_up_to_capacity():
+    bucket = TokenBucket(100, capacity=2)
+    time.sleep(0.1)
+    assert bucket.reserve() == 0
+    assert bucket.reserve() == 0
+    assert bucket.reserve() > 0
+
+
+def test_rate_limiters_are_shared_by_host():
+    a = get_rate_limiter('https://example.com/a', 5)
+    assert get_rate_limiter('https://example.com/b', 5) is a
+    assert get_rate_limiter('https://example.org/a', 5) is not a
+    assert get_rate_limiter('https://example.com/a', None) is None
+
+
+def test_call_with_retries(fake_time):
+    func = failing([TransientError(), TransientError()])
+    retried = []
+    assert call(func, max_retries=2, on_retry=retried.append) == 'ok'
+    assert len(func.calls) == 3
+    assert len(retried) == len(fake_time.sleeps) == 2
+
+
+def test_call_with_retries_gives_up_after_max_retries(fake_time):
+    func = failing([TransientError()] * 3)
+    with pytest.raises(TransientError):
+        call(func, max_retries=2)
+    assert len(func.calls) == 3
+
+
+def test_call_with_retries_does_not_retry_other_errors(fake_time):
+    func = failing([ValueError()])
+    with pytest.raises(ValueError):
+        call(func, max_retries=2)
+    assert len(func.calls) == 1
+    assert not fake_time.sleeps
+
+
+def test_call_with_retries_waits_retry_after(fake_time):
+    func = failing([TransientError(retry_after=30)])
+    call(func, max_retries=1)
+    assert fake_time.sleeps[0] >= 30
+
+
+def test_backoff_delay():
+    for attempt in range(10):
+        assert 0 <= get_backoff_delay(attempt) <= BACKOFF_MAX
+    assert get_backoff_delay(0, retry_after=5) >= 5
+    assert parse_retry_after('3') == 3
+    assert parse_retry_after('1000') == BACKOFF_MAX
+    assert parse_retry_after('Wed, 21 Oct 2015 07:28:00 GMT') is None
+    assert parse_retry_after(None) is None
@@ -0,0 +1,178 @@
+# -*- coding: utf-8 -*-
+
+import csv
+import json
+import os
+
+import fiona
+import pytest
+from shapely.geometry import LineString, Point, Polygon, box, mapping
+from shapely.ops import unary_union
+
+import ideuy.cache
+import ideuy.vector
+from ideuy.grid import load_grid_index
+from ideuy.vector import (filter_by_aois, make_valid_shape, merge_boxes,
+                          query_grid_by_aoi, union_shapes,
+                          union_shapes_parallel)
+
+__author__ = "Damián Silvani"
+__copyright__ = "Damián Silvani"
+__license__ = "mit"
+
+GRID_SIZE = 10
+
+
+def write_grid(path):
+    features = [{
+        'type': 'Feature',
+        'properties': {
+            'Nombre': f'C{y}{x}',
+            'data_path': f'{y}{x}'
+        },
+        'geometry': {
+            'type':
+            'Polygon',
+            'coordinates': [[[x, y], [x + 1, y], [x + 1, y + 1], [x, y + 1],
+                             [x, y]]]
+        }
+    } for y in range(GRID_SIZE) for x in range(GRID_SIZE)]
+    with open(path, 'w') as f:
+        json.dump({'type': 'FeatureCollection', 'features': features}, f)
+
+
+@pytest.fixture
+def grid_path(tmp_path, monkeypatch):
+    monkeypatch.setattr(ideuy.cache, 'CACHE_DIR', str(tmp_path / 'cache'))
+    path = str(tmp_path / 'grid.geojson')
+    write_grid(path)
+    load_grid_index.cache_clear()
+    yield path
+    load_grid_index.cache_clear()
+
+
+@pytest.fixture
+def grid(grid_path):
+    return load_grid_index(grid_path)
+
+
+def query(grid, aoi, simplify=False):
+    return query_grid_by_aoi(grid, aoi, grid.crs_wkt, simplify=simplify)
+
+
+@pytest.mark.parametrize(
+    'aoi',
+    [
+        # Detailed polygon
+        Point(5, 5).buffer(3.3, quad_segs=256),
+        # Polygons smaller than the simplify tolerance
+        box(2.4, 3.4, 2.44, 3.43),
+        Polygon([(7.5, 1.5), (7.52, 1.5), (7.51, 1.52)]),
+        unary_union([
+            Point(2, 2).buffer(1.5, quad_segs=64),
+            box(8.1, 8.1, 8.12, 8.12)
+        ]),
+    ])
+def test_simplified_query_is_superset_of_exact_query(grid, aoi):
+    exact = query(grid, aoi)
+    assert exact
+    assert set(query(grid, aoi, simplify=True)) >= set(exact)
+
+
+def test_make_valid_shape():
+    bowtie = Polygon([(0, 0), (2, 2), (2, 0), (0, 2)])
+    assert make_valid_shape(bowtie).area == pytest.approx(2)
+    # Spike collapses into a line, which is kept
+    spike = Polygon([(0, 0), (1, 0), (1, 1), (1, 3), (1, 1), (0, 1)])
+    valid = make_valid_shape(spike)
+    assert valid.is_valid
+    assert valid.area == pytest.approx(1)
+    assert valid.covers(LineString([(1, 1), (1, 3)]))
+
+
+@pytest.mark.parametrize('with_lines', [False, True])
+def test_union_shapes_parallel(monkeypatch, with_lines):
+    monkeypatch.setattr(ideuy.vector, 'UNION_CHUNK_SIZE', 10)
+    shapes = [box(x, y, x + 1.5, y + 1.5) for x in range(8) for y in range(5)]
+    shapes.append(Polygon([(20, 0), (22, 2), (22, 0), (20, 2)]))
+    if with_lines:
+        shapes += [Point(30, 30), LineString([(0, 0), (40, 0)])]
+    union = union_shapes_parallel(shapes, num_jobs=2)
+    expected = union_shapes(shapes)
+    assert union.is_valid
+    assert union.geom_type == expected.geom_type
+    assert union.symmetric_difference(expected).is_empty
+
+
+def test_merge_boxes():
+    boxes = [box(0, 0, 1, 1), box(1.05, 0, 2, 1), box(5, 5, 6, 6)]
+    assert merge_boxes([]) == []
+    assert sorted(b.bounds for b in merge_boxes(boxes)) == [
+        (0, 0, 1, 1), (1.05, 0, 2, 1), (5, 5, 6, 6)
+    ]
+    merged = sorted(b.bounds for b in merge_boxes(boxes, distance=0.1))
+    assert merged == [pytest.approx((0, 0, 2, 1)), pytest.approx((5, 5, 6, 6))]
+
+
+SCHEMA = {'geometry': 'Polygon', 'properties': {}}
+AOIS = {'a': box(0.5, 0.5, 1.5, 0.8), 'b': box(5.2, 5.2, 5.4, 5.4)}
+CELLS = {'a': ['C00', 'C01'], 'b': ['C55']}
+
+
+def write_aoi(path, shp, driver='GeoJSON', layer=None):
+    with fiona.open(path,
+                    'w',
+                    driver=driver,
+                    schema=SCHEMA,
+                    crs='EPSG:4326',
+                    layer=layer) as dst:
+        dst.write({'geometry': mapping(shp), 'properties': {}})
+
+
+def read_cells(path):
+    with fiona.open(path) as src:
+        return [f['properties']['Nombre'] for f in src]
+
+
+def test_filter_by_aois_directory(grid_path, tmp_path):
+    aoi_dir = tmp_path / 'aois'
+    os.makedirs(aoi_dir)
+    write_aoi(str(aoi_dir / 'a.geojson'), AOIS['a'])
+    write_aoi(str(aoi_dir / 'b.shp'), AOIS['b'], driver='ESRI Shapefile')
+    output = tmp_path / 'output'
+    filter_by_aois(str(aoi_dir),
+                   output=str(output),
+                   type_id=None,
+                   grid_vector=grid_path)
+    assert sorted(os.listdir(output)) == ['a.geojson', 'b.geojson']
+    for aoi_id, cells in CELLS.items():
+        assert read_cells(str(output / f'{aoi_id}.geojson')) == cells
+
+
+def test_filter_by_aois_multi_layer_table(grid_path, tmp_path):
+    aoi_path = str(tmp_path / 'aois.gpkg')
+    for aoi_id, shp in AOIS.items():
+        write_aoi(aoi_path, shp, driver='GPKG', layer=aoi_id)
+    output = str(tmp_path / 'cells.csv')
+    filter_by_aois(aoi_path,
+                   table=True,
+                   output=output,
+                   type_id=None,
+                   grid_vector=grid_path)
+    with open(output) as f:
+        rows = list(csv.reader(f))
+    assert rows == [['aoi_id', 'cell']] + [[aoi_id, cell]
+                                           for aoi_id, cells in CELLS.items()
+                                           for cell in cells]
+
+
+def test_filter_by_aois_with_same_name(grid_path, tmp_path):
+    aoi_dir = tmp_path / 'aois'
+    os.makedirs(aoi_dir)
+    write_aoi(str(aoi_dir / 'a.geojson'), AOIS['a'])
+    write_aoi(str(aoi_dir / 'a.shp'), AOIS['b'], driver='ESRI Shapefile')
+    with pytest.raises(RuntimeError):
+        filter_by_aois(str(aoi_dir),
+                       output=str(tmp_path / 'output'),
+                       type_id=None,
+                       grid_vector=grid_path)